@@ -1,5 +1,6 @@
 import hashlib
 import threading
+import asyncio
 import socket
 import os
 import time
@@ -8,17 +9,131 @@ import math
 import json
 import pprint
 import random
-from contextlib import suppress
+import queue
+import bisect
+import heapq
+import struct
+import zlib
+import base64
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress, contextmanager
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import sv_ttk
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 TRACKER_URL = 'http://192.168.0.102:8000'
 
+# version, message type, flags, reserved, piece index, offset, length, payload length
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBBBIIII')
+# largest payload accepted in one frame: a block, or a file name plus bitfield and peer list
+MAX_PAYLOAD = 4 * 1024 * 1024
+MSG_HELLO = 0
+MSG_LENGTH = 1
+MSG_BLOCK = 2
+MSG_ERROR = 3
+MSG_BITFIELD = 4
+MSG_HAVE = 5
+# block compression codecs, negotiated in the hello exchange and sent in the block reply flags
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+# decompressors stop after limit bytes so a small payload cannot expand into an arbitrarily large block
+CODECS = {CODEC_ZLIB: (lambda data: zlib.compress(data, 1),
+                       lambda data, limit: zlib.decompressobj().decompress(data, limit))}
+if lzma is not None:
+    CODECS[CODEC_LZMA] = (lambda data: lzma.compress(data, preset=0),
+                          lambda data, limit: lzma.LZMADecompressor().decompress(data, max_length=limit))
+if zstandard is not None:
+    CODECS[CODEC_ZSTD] = (lambda data: zstandard.compress(data, 3),
+                          lambda data, limit: zstandard.ZstdDecompressor().stream_reader(data).read(limit))
+# IPv4 address and listening port of a peer, as exchanged in bitfield replies
+PEER_ADDR = struct.Struct('!4sH')
+
+class DownloadCancelled(Exception):
+    def __init__(self, transferred=0):
+        super().__init__("Download cancelled, piece already completed")
+        self.transferred = transferred
+
+def recv_exact(sock, length, buffer=None):
+    if buffer is None:
+        buffer = bytearray(length)
+    view = memoryview(buffer)[:length]
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+        if count == 0:
+            raise ConnectionError(f"Connection closed after {received} of {length} bytes")
+        received += count
+    return buffer
+
+def pack_frame(msg_type, piece_index=0, offset=0, length=0, payload=b'', flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, 0, piece_index, offset, length, len(payload)) + payload
+
+def send_frame(sock, msg_type, piece_index=0, offset=0, length=0, payload=b'', flags=0):
+    sock.sendall(pack_frame(msg_type, piece_index, offset, length, payload, flags))
+
+def decompress_block(codec, data, length):
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression codec {codec}")
+    block = CODECS[codec][1](bytes(data), length + 1)
+    if len(block) > length:
+        raise ValueError(f"Decompressed block is larger than the {length} bytes expected")
+    if len(block) != length:
+        raise ValueError(f"Decompressed block has {len(block)} bytes, expected {length}")
+    return block
+
+def unpack_frame_header(header):
+    version, msg_type, flags, reserved, piece_index, offset, length, payload_length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol version {version}")
+    if payload_length > MAX_PAYLOAD:
+        raise ValueError(f"Frame payload of {payload_length} bytes exceeds {MAX_PAYLOAD}")
+    return msg_type, flags, piece_index, offset, length, payload_length
+
+def recv_frame_header(sock, buffer):
+    return unpack_frame_header(recv_exact(sock, HEADER.size, buffer))
+
+def bitfield_has(bitfield, index):
+    return index // 8 < len(bitfield) and bool(bitfield[index // 8] & (0x80 >> index % 8))
+
+def bitfield_set(bitfield, index):
+    if index // 8 >= len(bitfield):
+        bitfield.extend(bytes(index // 8 + 1 - len(bitfield)))
+    bitfield[index // 8] |= 0x80 >> index % 8
+
+def pieces_to_ranges(piece_indices):
+    ranges = []
+    for index in sorted(piece_indices):
+        if ranges and index <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], index)
+        else:
+            ranges.append([index, index])
+    return ranges
+
+def pack_peers(addrs):
+    return b''.join(PEER_ADDR.pack(socket.inet_aton(ip), port) for ip, port in addrs)
+
+def unpack_peers(data):
+    return [(socket.inet_ntoa(ip), port) for ip, port in PEER_ADDR.iter_unpack(data)]
+
 class File:
     def __init__(self, path: str, ip, log_callback=None):
         self.piece_size = 102400
         self.block_size = self.piece_size // 2
+        self.read_size = 65536
+        self.hash_workers = os.cpu_count() or 1
+        self.hash_batch = 8
         self.path = path
         self.peer_ip = ip
         self.log_callback = log_callback
@@ -31,12 +146,11 @@ class File:
         sha1_digest = sha1_hash.hexdigest()
         return sha1_digest
 
-    def divide_file_into_pieces(self):
+    def divide_file_into_pieces(self, stream=False):
         name = os.path.basename(self.path)
-        pieces = []
-        total_data = bytearray()
         file_info = {}
         piece_mappings = []
+        sources = []
         current_offset = 0
 
         if os.path.isdir(self.path):
@@ -57,38 +171,110 @@ class File:
                     full_path = os.path.join(name, relative_path)
                     file_size = os.path.getsize(file_path)
                     file_info[full_path] = file_size
-                    with open(file_path, 'rb') as f:
-                        file_data = f.read()
-                        total_data.extend(file_data)
-                        start_piece_index = current_offset // self.piece_size
-                        end_piece_index = (current_offset + file_size - 1) // self.piece_size
-                        piece_mappings.append({
-                            'file_path': full_path,
-                            'start_piece': start_piece_index,
-                            'end_piece': end_piece_index,
-                            'start_offset': current_offset,
-                            'end_offset': (current_offset + file_size - 1)
-                        })
-                        current_offset += file_size
-                        self.show_progress(name, current_offset, total_size)
+                    sources.append((file_path, file_size))
+                    start_piece_index = current_offset // self.piece_size
+                    end_piece_index = (current_offset + file_size - 1) // self.piece_size
+                    piece_mappings.append({
+                        'file_path': full_path,
+                        'start_piece': start_piece_index,
+                        'end_piece': end_piece_index,
+                        'start_offset': current_offset,
+                        'end_offset': (current_offset + file_size - 1)
+                    })
+                    current_offset += file_size
         elif os.path.isfile(self.path):
-            with open(self.path, 'rb') as f:
-                file_data = f.read()
-                total_data.extend(file_data)
-                full_path = name
-                file_info[full_path] = total_size
-                self.show_progress(name, total_size, total_size)
-        for i in range(0, len(total_data), self.piece_size):
-            piece = total_data[i:i + self.piece_size]
-            pieces.append(piece)
-        return {
+            full_path = name
+            file_info[full_path] = total_size
+            sources.append((self.path, total_size))
+        result = {
             'name': name,
-            'pieces': pieces,
+            'sources': sources,
             'info': {
                 'file_info': file_info,
                 'piece_mappings': piece_mappings
             }
         }
+        if stream and self.hash_workers > 1:
+            result['piece_hashes'] = self.hash_pieces_parallel(name, sources, total_size)
+        elif stream:
+            result['piece_hashes'] = [self.calculate_sha1(piece)
+                                      for piece in self.iter_pieces(name, sources, total_size)]
+        else:
+            result['pieces'] = list(self.iter_pieces(name, sources, total_size))
+        return result
+
+    def iter_pieces(self, name, sources, total_size):
+        piece = bytearray()
+        processed = 0
+        for file_path, file_size in sources:
+            with open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(min(self.read_size, self.piece_size - len(piece)))
+                    if not chunk:
+                        break
+                    piece.extend(chunk)
+                    if len(piece) == self.piece_size:
+                        yield bytes(piece)
+                        piece.clear()
+            processed += file_size
+            self.show_progress(name, processed, total_size)
+        if piece:
+            yield bytes(piece)
+
+    def read_range(self, sources, starts, offset, length):
+        data = bytearray()
+        i = bisect.bisect_right(starts, offset) - 1
+        while length > 0 and i < len(sources):
+            file_path, file_size = sources[i]
+            file_offset = offset - starts[i]
+            count = min(length, file_size - file_offset)
+            if count > 0:
+                with open(file_path, 'rb') as f:
+                    if hasattr(os, 'pread'):
+                        data.extend(os.pread(f.fileno(), count, file_offset))
+                    else:
+                        f.seek(file_offset)
+                        data.extend(f.read(count))
+                offset += count
+                length -= count
+            i += 1
+        return data
+
+    def hash_piece_range(self, sources, starts, total_size, first, last):
+        hashes = []
+        for index in range(first, last):
+            offset = index * self.piece_size
+            piece = self.read_range(sources, starts, offset, min(self.piece_size, total_size - offset))
+            hashes.append(self.calculate_sha1(piece))
+        return hashes
+
+    def hash_pieces_parallel(self, name, sources, total_size, workers=None):
+        workers = workers or self.hash_workers
+        starts = []
+        current_offset = 0
+        for file_path, file_size in sources:
+            starts.append(current_offset)
+            current_offset += file_size
+        number_of_pieces = math.ceil(total_size / self.piece_size)
+        ranges = [(first, min(first + self.hash_batch, number_of_pieces))
+                  for first in range(0, number_of_pieces, self.hash_batch)]
+        piece_hashes = []
+        reported = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda r: self.hash_piece_range(sources, starts, total_size, *r), ranges)
+            for (first, last), hashes in zip(ranges, results):
+                piece_hashes.extend(hashes)
+                processed = min(last * self.piece_size, total_size)
+                while reported < len(sources) and starts[reported] + sources[reported][1] <= processed:
+                    reported += 1
+                    self.show_progress(name, starts[reported - 1] + sources[reported - 1][1], total_size)
+        return piece_hashes
+
+    def hash_pieces(self, pieces):
+        if self.hash_workers <= 1:
+            return [self.calculate_sha1(piece) for piece in pieces]
+        with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+            return list(executor.map(self.calculate_sha1, pieces))
 
     def show_progress(self, filename, processed, total):
         progress = int(50 * processed / total)
@@ -101,7 +287,10 @@ class File:
         time.sleep(0.5)
 
     def create_torrent_file(self, file_data):
-        pieces_hash = ''.join([self.calculate_sha1(piece) for piece in file_data['pieces']])
+        if 'piece_hashes' in file_data:
+            pieces_hash = ''.join(file_data['piece_hashes'])
+        else:
+            pieces_hash = ''.join(self.hash_pieces(file_data['pieces']))
         torrent_data = {
             'announce': TRACKER_URL,
             'info': {
@@ -142,8 +331,858 @@ class File:
             else:
                 self.log_callback(msg)
 
+class PieceStore:
+    def __init__(self, index_path, log_callback=None):
+        self.index_path = index_path
+        self.log_callback = log_callback
+        self.torrents = {}
+        self.index = {}
+        self.layouts = {}
+        self.haves = {}
+        self.handles = OrderedDict()
+        self.max_handles = 128
+        self.handle_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.load()
+
+    def update_gui_log(self, msg, color=None):
+        if self.log_callback:
+            if color:
+                self.log_callback(msg, color)
+            else:
+                self.log_callback(msg)
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r') as f:
+            torrents = json.load(f)
+        for name, torrent in torrents.items():
+            missing = [path for path, start, size in torrent['files']
+                       if not os.path.isfile(path) or os.path.getsize(path) != size]
+            if missing:
+                msg = f"Dropping {name} from piece store, changed or missing: {missing}"
+                self.update_gui_log(msg, "red")
+                continue
+            self.torrents[name] = torrent
+            self.layouts[name] = self.build_pieces(torrent)
+            have = torrent.get('have')
+            self.haves[name] = None if have is None else bytearray.fromhex(have)
+            self.index[name] = [ref if have is None or bitfield_has(self.haves[name], index) else None
+                                for index, ref in enumerate(self.layouts[name])]
+
+    def save(self):
+        for name, have in self.haves.items():
+            self.torrents[name]['have'] = None if have is None else have.hex()
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.torrents, f)
+        os.replace(temp_path, self.index_path)
+
+    def add(self, name, piece_length, total_length, files, have=None):
+        torrent = {
+            'piece length': piece_length,
+            'length': total_length,
+            'files': [[os.path.abspath(path), start, size] for path, start, size in files]
+        }
+        with self.lock:
+            existing = self.torrents.get(name)
+            if existing and existing['piece length'] == piece_length and existing['length'] == total_length:
+                merged = {start: [path, start, size] for path, start, size in existing['files']}
+                merged.update({start: [path, start, size] for path, start, size in torrent['files']})
+                torrent['files'] = [merged[start] for start in sorted(merged)]
+            layout = self.build_pieces(torrent)
+            pieces = layout
+            bitfield = None
+            if have is not None:
+                current = self.index.get(name) or []
+                have = set(have)
+                carried = [index < len(current) and ref is not None and current[index] == ref
+                           for index, ref in enumerate(layout)]
+                pieces = [ref if index in have or carried[index] else None for index, ref in enumerate(layout)]
+                bitfield = bytearray()
+                for index, ref in enumerate(pieces):
+                    if ref is not None:
+                        bitfield_set(bitfield, index)
+            with self.handle_lock:
+                for path, start, size in torrent['files']:
+                    self.drop_handle(path)
+            index = dict(self.index)
+            index[name] = pieces
+            self.index = index
+            self.layouts[name] = layout
+            self.haves[name] = bitfield
+            self.torrents[name] = torrent
+            self.save()
+
+    def mark(self, name, index):
+        with self.lock:
+            layout = self.layouts.get(name)
+            pieces = self.index.get(name)
+            if pieces is None or not 0 <= index < len(pieces) or layout[index] is None:
+                return False
+            if pieces[index] is None:
+                pieces[index] = layout[index]
+                bitfield_set(self.haves[name], index)
+            return True
+
+    def flush(self):
+        with self.lock:
+            self.save()
+
+    def build_pieces(self, torrent):
+        piece_length = torrent['piece length']
+        total_length = torrent['length']
+        files = sorted((file for file in torrent['files'] if file[2] > 0), key=lambda file: file[1])
+        pieces = []
+        i = 0
+        for piece_start in range(0, total_length, piece_length):
+            piece_end = min(piece_start + piece_length, total_length)
+            while i < len(files) and files[i][1] + files[i][2] <= piece_start:
+                i += 1
+            segments = []
+            covered = piece_start
+            j = i
+            while j < len(files) and covered < piece_end and files[j][1] <= covered:
+                path, start, size = files[j]
+                length = min(start + size, piece_end) - covered
+                segments.append((path, covered - start, length))
+                covered += length
+                j += 1
+            if covered == piece_end:
+                pieces.append((piece_end - piece_start, tuple(segments)))
+            else:
+                pieces.append(None)
+        return pieces
+
+    def piece_ref(self, name, index):
+        pieces = self.index.get(name)
+        if pieces is None or not 0 <= index < len(pieces):
+            return None
+        return pieces[index]
+
+    def bitfield(self, name):
+        bitfield = bytearray()
+        for index, ref in enumerate(self.index.get(name) or []):
+            if ref is not None:
+                bitfield_set(bitfield, index)
+        return bitfield
+
+    def piece_segments(self, name, index):
+        ref = self.piece_ref(name, index)
+        return None if ref is None else ref[1]
+
+    def piece_length(self, name, index):
+        ref = self.piece_ref(name, index)
+        return 0 if ref is None else ref[0]
+
+    @contextmanager
+    def open_handle(self, path):
+        with self.handle_lock:
+            entry = self.handles.get(path)
+            if entry is None:
+                entry = [os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0)), 0]
+                self.handles[path] = entry
+                while len(self.handles) > self.max_handles:
+                    self.drop_handle(next(iter(self.handles)))
+            self.handles.move_to_end(path)
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self.handle_lock:
+                entry[1] -= 1
+                if entry[1] == 0 and self.handles.get(path) is not entry:
+                    os.close(entry[0])
+
+    def drop_handle(self, path):
+        entry = self.handles.pop(path, None)
+        if entry is not None and entry[1] == 0:
+            os.close(entry[0])
+
+    def block_segments(self, name, index, offset, length):
+        segments = self.piece_segments(name, index)
+        if segments is None:
+            return None
+        block = []
+        for path, segment_offset, segment_length in segments:
+            if length <= 0:
+                break
+            if offset >= segment_length:
+                offset -= segment_length
+                continue
+            count = min(length, segment_length - offset)
+            block.append((path, segment_offset + offset, count))
+            length -= count
+            offset = 0
+        return block
+
+    def read(self, name, index, offset, length):
+        block = self.block_segments(name, index, offset, length)
+        if block is None:
+            return None
+        data = bytearray()
+        for path, file_offset, count in block:
+            if hasattr(os, 'pread'):
+                with self.open_handle(path) as handle:
+                    data.extend(os.pread(handle, count, file_offset))
+            else:
+                with open(path, 'rb') as f:
+                    f.seek(file_offset)
+                    data.extend(f.read(count))
+        return data
+
+    def send_block(self, sock, name, index, offset, length, use_sendfile=True):
+        block = self.block_segments(name, index, offset, length)
+        if block is None:
+            return 0
+        if use_sendfile and hasattr(os, 'sendfile') and len(block) == 1:
+            path, file_offset, count = block[0]
+            total = 0
+            with self.open_handle(path) as handle:
+                while total < count:
+                    sent = os.sendfile(sock.fileno(), handle, file_offset + total, count - total)
+                    if sent == 0:
+                        raise ConnectionError(f"Peer closed connection while sending {name} piece {index}")
+                    total += sent
+            return total
+        data = memoryview(self.read(name, index, offset, length))
+        sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        with self.handle_lock:
+            for path in list(self.handles):
+                self.drop_handle(path)
+
+class PieceWriter:
+    def __init__(self, bitfield_path, files, piece_length, total_length, piece_hashes):
+        self.bitfield_path = bitfield_path
+        self.files = sorted(files, key=lambda file: file[1])
+        self.starts = [start for path, start, size in self.files]
+        self.piece_length = piece_length
+        self.total_length = total_length
+        layout = json.dumps(self.files)
+        self.digest = hashlib.sha1((piece_hashes + layout).encode()).digest()
+        self.bitfield = bytearray((math.ceil(total_length / piece_length) + 7) // 8)
+        self.handles = []
+        self.lock = threading.Lock()
+
+    def open(self):
+        resumable = os.path.exists(self.bitfield_path) and all(
+            os.path.isfile(path) and os.path.getsize(path) == size for path, start, size in self.files)
+        if resumable:
+            with open(self.bitfield_path, 'rb') as f:
+                data = f.read()
+            if data[:len(self.digest)] == self.digest and len(data) == len(self.digest) + len(self.bitfield):
+                self.bitfield[:] = data[len(self.digest):]
+        for path, start, size in self.files:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            handle = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+            self.handles.append(handle)
+            os.ftruncate(handle, size)
+            if hasattr(os, 'posix_fallocate') and size:
+                with suppress(OSError):
+                    os.posix_fallocate(handle, 0, size)
+        return self
+
+    def has(self, piece_index):
+        return bitfield_has(self.bitfield, piece_index)
+
+    def segments(self, piece_index):
+        piece_start = piece_index * self.piece_length
+        piece_end = min(piece_start + self.piece_length, self.total_length)
+        segments = []
+        i = max(bisect.bisect_right(self.starts, piece_start) - 1, 0)
+        while i < len(self.files) and self.files[i][1] < piece_end:
+            path, start, size = self.files[i]
+            low = max(start, piece_start)
+            high = min(start + size, piece_end)
+            if low < high:
+                segments.append((self.handles[i], low - start, low - piece_start, high - low))
+            i += 1
+        return segments
+
+    def write(self, piece_index, piece):
+        view = memoryview(piece)
+        for handle, file_offset, piece_offset, length in self.segments(piece_index):
+            data = view[piece_offset:piece_offset + length]
+            if hasattr(os, 'pwrite'):
+                while data:
+                    written = os.pwrite(handle, data, file_offset)
+                    data = data[written:]
+                    file_offset += written
+            else:
+                with self.lock:
+                    os.lseek(handle, file_offset, os.SEEK_SET)
+                    while data:
+                        data = data[os.write(handle, data):]
+        with self.lock:
+            bitfield_set(self.bitfield, piece_index)
+            temp_path = self.bitfield_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(self.digest + self.bitfield)
+            os.replace(temp_path, self.bitfield_path)
+
+    def close(self):
+        for handle in self.handles:
+            os.close(handle)
+        self.handles = []
+
+    def finish(self):
+        self.close()
+        with suppress(FileNotFoundError):
+            os.remove(self.bitfield_path)
+
+class ConnectionPool:
+    def __init__(self, max_per_peer=4, idle_timeout=30, connect_timeout=5, read_timeout=30):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = {}
+        self.active = {}
+        self.condition = threading.Condition()
+
+    def purge_idle(self):
+        now = time.monotonic()
+        for addr, sockets in self.idle.items():
+            while sockets and now - sockets[0][1] > self.idle_timeout:
+                sock, last_used = sockets.pop(0)
+                sock.close()
+
+    def acquire(self, addr):
+        addr = tuple(addr)
+        with self.condition:
+            self.purge_idle()
+            while self.active.get(addr, 0) >= self.max_per_peer:
+                self.condition.wait()
+            self.active[addr] = self.active.get(addr, 0) + 1
+            idle = self.idle.get(addr)
+            if idle:
+                sock, last_used = idle.pop()
+                return sock, True
+        try:
+            sock = socket.create_connection(addr, timeout=self.connect_timeout)
+            sock.settimeout(self.read_timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            self.discard(addr, None)
+            raise
+        return sock, False
+
+    def release(self, addr, sock):
+        addr = tuple(addr)
+        with self.condition:
+            self.active[addr] -= 1
+            self.idle.setdefault(addr, []).append((sock, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, addr, sock):
+        addr = tuple(addr)
+        if sock is not None:
+            sock.close()
+        with self.condition:
+            self.active[addr] -= 1
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            for sockets in self.idle.values():
+                for sock, last_used in sockets:
+                    sock.close()
+            self.idle.clear()
+
+class AsyncConnectionPool:
+    def __init__(self, max_per_peer=4, idle_timeout=30, connect_timeout=5, read_timeout=30):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = {}
+        self.slots = {}
+
+    async def acquire(self, addr):
+        slot = self.slots.setdefault(addr, asyncio.Semaphore(self.max_per_peer))
+        await slot.acquire()
+        idle = self.idle.get(addr)
+        now = time.monotonic()
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used <= self.idle_timeout and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*addr), self.connect_timeout)
+        except BaseException:
+            slot.release()
+            raise
+        return reader, writer, False
+
+    def release(self, addr, reader, writer):
+        self.idle.setdefault(addr, []).append((reader, writer, time.monotonic()))
+        self.slots[addr].release()
+
+    def discard(self, addr, writer):
+        writer.close()
+        self.slots[addr].release()
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer, last_used in connections:
+                writer.close()
+        self.idle.clear()
+
+class PipelineWindow:
+    def __init__(self, size=4, max_size=32):
+        self.size = size
+        self.max_size = max_size
+        self.rtt = None
+        self.rate = None
+        self.lock = threading.Lock()
+
+    def observe_rtt(self, rtt):
+        with self.lock:
+            self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+
+    def observe_transfer(self, transferred, elapsed, block_size):
+        with self.lock:
+            rate = transferred / max(elapsed, 1e-6)
+            self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+            if self.rtt is None:
+                target = self.size + 1
+            else:
+                target = math.ceil(self.rate * self.rtt / block_size) + 2
+            self.size = max(1, min(self.max_size, target))
+
+    def shrink(self):
+        with self.lock:
+            self.size = max(1, self.size // 2)
+
+class PiecePicker:
+    def __init__(self, peer_set):
+        self.availability = {}
+        self.pending = set()
+        self.heap = []
+        self.lock = threading.Lock()
+        for piece_index, peer_ips in peer_set.items():
+            self.availability[piece_index] = []
+            self.pending.add(piece_index)
+        self.update(peer_set)
+
+    def update(self, peer_set):
+        with self.lock:
+            for piece_index, peer_ips in peer_set.items():
+                peers = self.availability.get(piece_index)
+                if peers is None:
+                    continue
+                added = False
+                for value in peer_ips:
+                    if tuple(value) not in peers:
+                        peers.append(tuple(value))
+                        added = True
+                if added and piece_index in self.pending:
+                    heapq.heappush(self.heap, (len(peers), random.random(), piece_index))
+
+    def pick(self):
+        with self.lock:
+            while self.heap:
+                count, tie, piece_index = heapq.heappop(self.heap)
+                if piece_index in self.pending and count == len(self.availability[piece_index]):
+                    self.pending.remove(piece_index)
+                    return piece_index, list(self.availability[piece_index])
+            return None, []
+
+    def claim(self, addr, count):
+        claimed = []
+        skipped = []
+        with self.lock:
+            while self.heap and len(claimed) < count and len(skipped) < 4 * count:
+                entry = heapq.heappop(self.heap)
+                peers_count, tie, piece_index = entry
+                if piece_index not in self.pending or peers_count != len(self.availability[piece_index]):
+                    continue
+                if addr in self.availability[piece_index]:
+                    self.pending.remove(piece_index)
+                    claimed.append(piece_index)
+                else:
+                    skipped.append(entry)
+            for entry in skipped:
+                heapq.heappush(self.heap, entry)
+        return claimed
+
+    def release(self, piece_index):
+        with self.lock:
+            if piece_index not in self.pending:
+                self.pending.add(piece_index)
+                heapq.heappush(self.heap, (len(self.availability[piece_index]), random.random(), piece_index))
+
+    def remaining(self):
+        with self.lock:
+            return sorted(self.pending)
+
+    def unavailable(self):
+        with self.lock:
+            return [piece_index for piece_index in self.pending if not self.availability[piece_index]]
+
+    def abandon_unavailable(self):
+        with self.lock:
+            abandoned = [piece_index for piece_index in self.pending if not self.availability[piece_index]]
+            self.pending.difference_update(abandoned)
+        return abandoned
+
+class DownloadSession:
+    def __init__(self, file, peer_set, announce, piece_hashes, writer):
+        self.file = file
+        self.announce = announce
+        self.piece_hashes = piece_hashes
+        self.writer = writer
+        self.corrupt = set()
+        self.pieces = set()
+        self.failed = []
+        self.remaining = len(peer_set)
+        self.picker = PiecePicker(peer_set)
+        self.refreshed = time.monotonic()
+        self.polled = self.refreshed
+        self.refresh_lock = threading.Lock()
+        self.met = set()
+        self.active = {}
+        self.tried = {}
+        self.endgame_requests = 0
+        self.duplicate_bytes = 0
+        self.condition = threading.Condition()
+
+    def meet(self, addr):
+        with self.condition:
+            if tuple(addr) in self.met:
+                return False
+            self.met.add(tuple(addr))
+            return True
+
+    def start_fetch(self, piece_index, addr):
+        with self.condition:
+            self.active.setdefault(piece_index, set()).add(addr)
+            self.tried.setdefault(piece_index, set()).add(addr)
+
+    def finish_fetch(self, piece_index, addr):
+        with self.condition:
+            self.active[piece_index].discard(addr)
+
+    def is_complete(self, piece_index):
+        return piece_index in self.pieces
+
+    def piece_size(self, piece_index):
+        return min(self.writer.piece_length, self.writer.total_length - piece_index * self.writer.piece_length)
+
+    def complete(self, piece_index, piece):
+        if piece_index not in self.pieces:
+            self.writer.write(piece_index, piece)
+        with self.condition:
+            if piece_index in self.pieces:
+                self.duplicate_bytes += len(piece)
+                return False
+            self.pieces.add(piece_index)
+            self.remaining -= 1
+            self.condition.notify_all()
+            return True
+
+    def verify(self, piece_index, piece):
+        expected = self.piece_hashes[40 * piece_index:40 * piece_index + 40]
+        if hashlib.sha1(piece).hexdigest() == expected:
+            return True
+        with self.condition:
+            self.corrupt.add(piece_index)
+        return False
+
+    def cancelled(self, transferred):
+        with self.condition:
+            self.duplicate_bytes += transferred
+
+    def fail(self, piece_index):
+        with self.condition:
+            if piece_index in self.pieces or piece_index in self.failed or self.active.get(piece_index):
+                return
+            self.failed.append(piece_index)
+            self.remaining -= 1
+            self.condition.notify_all()
+
+    def endgame_pick(self, threshold):
+        if self.picker.remaining():
+            return None, []
+        with self.condition:
+            in_flight = [piece_index for piece_index, addrs in self.active.items()
+                         if addrs and piece_index not in self.pieces]
+            if not in_flight or len(in_flight) > threshold:
+                return None, []
+            for piece_index in sorted(in_flight, key=lambda index: len(self.active[index])):
+                spare = [value for value in self.picker.availability[piece_index]
+                         if value not in self.tried[piece_index]]
+                if spare:
+                    self.endgame_requests += 1
+                    return piece_index, spare
+            return None, []
+
+    def wait(self):
+        with self.condition:
+            while self.remaining > 0:
+                self.condition.wait()
+        return not self.failed
+
+class DownloadScheduler:
+    def __init__(self, workers=16, max_per_peer=4, queue_size=64):
+        self.workers = workers
+        self.max_per_peer = max_per_peer
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.active = {}
+        self.condition = threading.Condition()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job()
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, job, *args):
+        self.start()
+        self.jobs.put(lambda: job(*args))
+
+    def acquire_peer(self, candidates, choose=random.choice):
+        with self.condition:
+            while True:
+                free = [tuple(addr) for addr in candidates if self.active.get(tuple(addr), 0) < self.max_per_peer]
+                if free:
+                    addr = choose(free)
+                    self.active[addr] = self.active.get(addr, 0) + 1
+                    return addr
+                self.condition.wait()
+
+    def release_peer(self, addr):
+        with self.condition:
+            self.active[tuple(addr)] -= 1
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.lock:
+            for _ in self.threads:
+                with suppress(queue.Full):
+                    self.jobs.put_nowait(None)
+            self.threads = []
+
+class DownloadQueue:
+    def __init__(self, download, log_callback=None):
+        self.download = download
+        self.log_callback = log_callback
+        self.jobs = queue.PriorityQueue()
+        self.sequence = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def update_gui_log(self, msg, color=None):
+        if self.log_callback:
+            if color:
+                self.log_callback(msg, color)
+            else:
+                self.log_callback(msg)
+
+    def put(self, file, priority=0):
+        with self.lock:
+            self.jobs.put((priority, self.sequence, file))
+            self.sequence += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, daemon=True)
+                self.thread.start()
+
+    def work(self):
+        while True:
+            priority, sequence, file = self.jobs.get()
+            if file is None:
+                break
+            try:
+                self.download(file)
+            except Exception as e:
+                msg = f"Queued download of {file} failed: {e}"
+                self.update_gui_log(msg, "red")
+
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.jobs.put((-math.inf, -1, None))
+                self.thread = None
+
+class HaveBatcher:
+    def __init__(self, announce, batch_size=8, interval=0.5):
+        self.announce = announce
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = {}
+        self.oldest = 0.0
+        self.batches = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self, file, piece_indices):
+        if not piece_indices:
+            return
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.monotonic()
+                self.batches.put((file, []))
+            pending = self.pending.setdefault(file, [])
+            pending.extend(piece_indices)
+            if len(pending) >= self.batch_size:
+                self.batches.put((file, self.pending.pop(file)))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, daemon=True)
+                self.thread.start()
+
+    def flush(self, file):
+        with self.lock:
+            piece_indices = self.pending.pop(file, [])
+        if piece_indices:
+            self.announce(file, piece_indices)
+
+    def work(self):
+        while True:
+            with self.lock:
+                timeout = max(0.0, self.oldest + self.interval - time.monotonic()) if self.pending else None
+            try:
+                file, piece_indices = self.batches.get(timeout=timeout)
+            except queue.Empty:
+                with self.lock:
+                    pending, self.pending = self.pending, {}
+                for file, piece_indices in pending.items():
+                    self.announce(file, piece_indices)
+                continue
+            if file is None:
+                break
+            if piece_indices:
+                self.announce(file, piece_indices)
+
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.batches.put((None, None))
+                self.thread = None
+
+class Swarm:
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def add(self, file, addr):
+        with self.lock:
+            self.files.setdefault(file, {}).setdefault(tuple(addr), None)
+
+    def update(self, file, addr, bitfield):
+        with self.lock:
+            self.files.setdefault(file, {})[tuple(addr)] = bytearray(bitfield)
+
+    def have(self, file, addr, piece_index):
+        with self.lock:
+            peers = self.files.setdefault(file, {})
+            bitfield = peers.get(tuple(addr)) or bytearray()
+            bitfield_set(bitfield, piece_index)
+            peers[tuple(addr)] = bitfield
+
+    def remove(self, file, addr):
+        with self.lock:
+            self.files.get(file, {}).pop(tuple(addr), None)
+
+    def known(self, file):
+        with self.lock:
+            return list(self.files.get(file, {}))
+
+    def unknown(self, file):
+        with self.lock:
+            return [addr for addr, bitfield in self.files.get(file, {}).items() if bitfield is None]
+
+    def sources(self, file, piece_indices):
+        with self.lock:
+            peers = [(addr, bitfield) for addr, bitfield in self.files.get(file, {}).items() if bitfield]
+        return {piece_index: [addr for addr, bitfield in peers if bitfield_has(bitfield, piece_index)]
+                for piece_index in piece_indices}
+
+class PeerScores:
+    def __init__(self, alpha=0.3, explore=0.1, base_backoff=1.0, max_backoff=60.0):
+        self.alpha = alpha
+        self.explore = explore
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def entry(self, addr):
+        return self.stats.setdefault(tuple(addr), {
+            'latency': None,
+            'throughput': None,
+            'failure_rate': 0.0,
+            'failures': 0,
+            'quarantined_until': 0.0
+        })
+
+    def average(self, old, new):
+        return new if old is None else (1 - self.alpha) * old + self.alpha * new
+
+    def record_latency(self, addr, seconds):
+        with self.lock:
+            entry = self.entry(addr)
+            entry['latency'] = self.average(entry['latency'], seconds)
+
+    def record_transfer(self, addr, transferred, seconds):
+        with self.lock:
+            entry = self.entry(addr)
+            entry['throughput'] = self.average(entry['throughput'], transferred / max(seconds, 1e-6))
+            entry['failure_rate'] = self.average(entry['failure_rate'], 0.0)
+            entry['failures'] = 0
+            entry['quarantined_until'] = 0.0
+
+    def record_failure(self, addr):
+        with self.lock:
+            entry = self.entry(addr)
+            entry['failure_rate'] = self.average(entry['failure_rate'], 1.0)
+            entry['failures'] += 1
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (entry['failures'] - 1))
+            entry['quarantined_until'] = time.monotonic() + backoff
+
+    def score(self, addr, optimistic):
+        entry = self.stats.get(tuple(addr))
+        if entry is None:
+            return optimistic
+        throughput = optimistic if entry['throughput'] is None else entry['throughput']
+        return max(throughput * (1.0 - entry['failure_rate']), 1e-6)
+
+    def choose(self, candidates):
+        candidates = [tuple(addr) for addr in candidates]
+        now = time.monotonic()
+        with self.lock:
+            usable = [addr for addr in candidates
+                      if self.stats.get(addr, {}).get('quarantined_until', 0.0) <= now]
+            if not usable:
+                return min(candidates, key=lambda addr: self.stats[addr]['quarantined_until'])
+            if len(usable) == 1 or random.random() < self.explore:
+                return random.choice(usable)
+            known = [entry['throughput'] for entry in self.stats.values() if entry['throughput']]
+            optimistic = max(known) if known else 1.0
+            weights = [self.score(addr, optimistic) for addr in usable]
+            return random.choices(usable, weights=weights)[0]
+
 class Peer(threading.Thread):
-    def __init__(self, port=5004, log_callback=None):
+    def __init__(self, port=5004, log_callback=None, engine='threads'):
         super().__init__()
         self.host_name = socket.gethostname()
         self.peer_ip = socket.gethostbyname(self.host_name)
@@ -151,7 +1190,41 @@ class Peer(threading.Thread):
         self.server_socket = None
         self.running = True
         self.OUTPUT_PATH = os.path.join(os.getcwd(), 'output')
-        self.files = []
+        self.piece_store = PieceStore(os.path.join(os.getcwd(), f'pieces-{self.port}.json'), log_callback)
+        self.use_sendfile = hasattr(os, 'sendfile')
+        self.download_scheduler = DownloadScheduler(workers=16, max_per_peer=4, queue_size=64)
+        self.connection_pool = ConnectionPool(max_per_peer=self.download_scheduler.max_per_peer)
+        self.peer_protocols = {}
+        self.pipeline_depth = 4
+        self.max_pipeline_depth = 32
+        self.pipeline_windows = {}
+        self.peer_scores = PeerScores()
+        self.engine = engine
+        self.loop = None
+        self.async_server = None
+        self.async_pool = None
+        self.async_concurrency = 256
+        self.io_workers = 8
+        self.io_executor = None
+        self.command_workers = 32
+        self.command_executor = None
+        self.async_tasks = set()
+        self.availability_refresh = 5.0
+        self.endgame_threshold = 4
+        self.download_queue = DownloadQueue(self.download, log_callback)
+        self.swarm = Swarm()
+        self.pex_limit = 50
+        self.tracker_refresh = 30.0
+        self.compression = [codec for codec in (CODEC_ZSTD, CODEC_ZLIB, CODEC_LZMA) if codec in CODECS]
+        self.compression_ratio = 0.9
+        self.compression_backoff = 8
+        self.max_compression_backoff = 256
+        self.have_batcher = HaveBatcher(self.announce_pieces, batch_size=8, interval=0.5)
+        self.tracker_pending = {}
+        self.tracker_lock = threading.Lock()
+        self.heartbeat_interval = 30.0
+        self.tracker_timeout = 5.0
+        self.stopped = threading.Event()
         self.SERVER_IP = '192.168.0.102'  # CHANGE THIS TO YOUR SERVER IP
         self.SERVER_PORT = 6000  # THIS SHOULD MATCH THE PORT IN s.py
         self.handle_file = File('', self.peer_ip, log_callback)
@@ -165,6 +1238,10 @@ class Peer(threading.Thread):
                 self.log_callback(msg)
 
     def run(self):
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        if self.engine == 'asyncio':
+            asyncio.run(self.run_async())
+            return
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.peer_ip, self.port))
         self.server_socket.listen(10)
@@ -176,6 +1253,7 @@ class Peer(threading.Thread):
                 client_socket, addr = self.server_socket.accept()
                 if not self.running:
                     break
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 # msg = f"\033[96mPeer {self.peer_ip}:{self.port} connected to {addr}\033[0m"
                 msg = f"Peer {self.peer_ip}:{self.port} connected to {addr}"
                 self.update_gui_log(msg, "cyan")
@@ -185,6 +1263,97 @@ class Peer(threading.Thread):
             msg = f"Peer {self.peer_ip} listening on port {self.port}"
             self.update_gui_log(msg, "yellow")
             self.server_socket.close()
+            self.piece_store.close()
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.async_pool = AsyncConnectionPool(self.download_scheduler.max_per_peer)
+        self.async_slots = asyncio.Semaphore(self.async_concurrency)
+        self.io_executor = ThreadPoolExecutor(max_workers=self.io_workers)
+        self.command_executor = ThreadPoolExecutor(max_workers=self.command_workers)
+        self.async_server = await asyncio.start_server(self.handle_client_async, self.peer_ip, self.port)
+        msg = f"Peer {self.peer_ip}:{self.port} listening on port {self.port}"
+        self.update_gui_log(msg, "yellow")
+        try:
+            async with self.async_server:
+                await self.async_server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            msg = f"Peer {self.peer_ip} listening on port {self.port}"
+            self.update_gui_log(msg, "yellow")
+            self.async_pool.close()
+            self.command_executor.shutdown(wait=False)
+            self.io_executor.shutdown(wait=True)
+            self.piece_store.close()
+
+    async def handle_client_async(self, reader, writer):
+        msg = f"Peer {self.peer_ip}:{self.port} connected to {writer.get_extra_info('peername')}"
+        self.update_gui_log(msg, "cyan")
+        try:
+            first = await reader.read(1)
+            if first and 0 < first[0] < 0x20:
+                await self.handle_binary_client_async(reader, writer, first)
+            elif first:
+                await self.handle_text_client_async(reader, writer, first)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_binary_client_async(self, reader, writer, first):
+        header = first + await reader.readexactly(HEADER.size - 1)
+        conn = {'host': writer.get_extra_info('peername')[0], 'codec': CODEC_NONE, 'skip': 0,
+                'backoff': self.compression_backoff}
+        while True:
+            msg_type, flags, piece_index, offset, length, payload_length = unpack_frame_header(header)
+            payload = await reader.readexactly(payload_length)
+            if msg_type == MSG_BLOCK:
+                frame, block = await self.loop.run_in_executor(
+                    self.io_executor, self.binary_response, msg_type, piece_index, offset, length, payload, conn)
+            else:
+                frame, block = self.binary_response(msg_type, piece_index, offset, length, payload, conn)
+            if frame:
+                writer.write(frame)
+            if block:
+                writer.write(await self.loop.run_in_executor(self.io_executor, self.piece_store.read, *block))
+            await writer.drain()
+            try:
+                header = await reader.readexactly(HEADER.size)
+            except asyncio.IncompleteReadError:
+                break
+
+    async def handle_text_client_async(self, reader, writer, first):
+        data = first + await reader.read(1023)
+        while data:
+            data = data.decode()
+            parts = data.split()
+            file, cmd = data.rsplit(' ', 1)
+            if cmd in ('download', 'upload'):
+                response = await self.loop.run_in_executor(self.command_executor, getattr(self, cmd), file)
+                writer.write(response.encode())
+            elif cmd == 'queue':
+                filename, priority = file.rsplit(' ', 1)
+                self.queue_download(filename, int(priority))
+                writer.write('Response OK'.encode())
+            elif cmd == 'block':
+                index, offset = parts[0].split('-')
+                filename = file.split(' ', 1)[1]
+                piece_length = self.piece_store.piece_length(filename, int(index))
+                if piece_length == 0:
+                    error_msg = f"Piece {index} not found for file {filename}"
+                    self.update_gui_log(error_msg, None)
+                    raise ValueError(error_msg)
+                offset = int(offset)
+                if offset < piece_length:
+                    end = min(offset + self.handle_file.block_size, piece_length)
+                    writer.write(await self.loop.run_in_executor(
+                        self.io_executor, self.piece_store.read, filename, int(index), offset, end - offset))
+            elif cmd == 'length':
+                filename, index = file.rsplit(' ', 1)
+                writer.write(str(self.piece_store.piece_length(filename, int(index))).encode())
+            await writer.drain()
+            data = await reader.read(1024)
 
     def update_tracker_upload(self, torrent_data):
         piece_length = torrent_data['info']['piece length']
@@ -199,7 +1368,7 @@ class Peer(threading.Thread):
             "peer_ip": self.peer_ip,
             "peer_port": self.port,
             "file_name": torrent_data['info']['name'],
-            "pieces_indices": list(range(number_of_pieces)),
+            "pieces_ranges": [[0, number_of_pieces - 1]] if number_of_pieces else [],
             "file_details": file_details
         }
         response = requests.post(torrent_data['announce'] + '/peer-update', json=payload)
@@ -211,12 +1380,59 @@ class Peer(threading.Thread):
             "peer_ip": self.peer_ip,
             "peer_port": self.port,
             "file_name": torrent_data['file_name'],
-            "pieces_indices": torrent_data['pieces_indices'],
         }
+        if 'pieces_bitfield' in torrent_data:
+            payload["pieces_bitfield"] = base64.b64encode(bytes(torrent_data['pieces_bitfield'])).decode()
+        else:
+            payload["pieces_ranges"] = pieces_to_ranges(torrent_data['pieces_indices'])
         response = requests.post(TRACKER_URL + '/peer-update-download', json=payload)
+        response.raise_for_status()
         msg = f"Peer {self.peer_ip}:{self.port} " + response.text
         self.update_gui_log(msg, None)
 
+    def heartbeat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                self.send_heartbeat()
+            except requests.RequestException as e:
+                msg = f"Failed to send heartbeat to the tracker: {e}"
+                self.update_gui_log(msg, None)
+
+    def send_heartbeat(self):
+        with self.piece_store.lock:
+            file_names = list(self.piece_store.torrents)
+        if not file_names:
+            return
+        payload = {
+            "peer_ip": self.peer_ip,
+            "peer_port": self.port,
+            "file_names": file_names,
+        }
+        response = requests.post(TRACKER_URL + '/heartbeat', json=payload, timeout=self.tracker_timeout)
+        response.raise_for_status()
+        for file_name in response.json().get('unknown', []):
+            bitfield = self.piece_store.bitfield(file_name)
+            if any(bitfield):
+                msg = f"Tracker lost {file_name}, announcing our pieces again"
+                self.update_gui_log(msg, "yellow")
+                self.update_tracker_download({"file_name": file_name, "pieces_bitfield": bitfield})
+
+    def announce_stopped(self):
+        with self.piece_store.lock:
+            file_names = list(self.piece_store.torrents)
+        if not file_names:
+            return
+        payload = {
+            "peer_ip": self.peer_ip,
+            "peer_port": self.port,
+            "file_names": file_names,
+        }
+        try:
+            requests.post(TRACKER_URL + '/peer-stopped', json=payload, timeout=self.tracker_timeout)
+        except requests.RequestException as e:
+            msg = f"Failed to announce stop to the tracker: {e}"
+            self.update_gui_log(msg, None)
+
     def calculate_piece_indices_for_file(self, torrent_data, filename):
         piece_length = torrent_data['info']['piece length']
         files = torrent_data['info'].get('files', [])
@@ -237,17 +1453,29 @@ class Peer(threading.Thread):
                 return []
         else:
             start_byte, end_byte = file_byte_ranges[filename]
+            if end_byte < start_byte:
+                return []
             start_index = start_byte // piece_length
             end_index = end_byte // piece_length
         return list(range(start_index, end_index + 1))
 
     def get_peers_for_pieces(self, tracker_url, filename, piece_indices):
-        piece_indices_str = ','.join(map(str, piece_indices))
-        url = f"{tracker_url}/get-peer?filename={filename}&piece_indices={piece_indices_str}"
+        piece_ranges = ','.join(f"{start}-{end}" for start, end in pieces_to_ranges(piece_indices))
         try:
-            response = requests.get(url)
+            response = requests.get(f"{tracker_url}/get-peer",
+                                    params={'filename': filename, 'piece_ranges': piece_ranges})
+            if response.status_code == 400:
+                response = requests.get(f"{tracker_url}/get-peer",
+                                        params={'filename': filename,
+                                                'piece_indices': ','.join(map(str, piece_indices))})
             response.raise_for_status()
             peer_data = response.json()
+            if 'peers' in peer_data:
+                msg = f"Received peer-set: {len(peer_data['peers'])} peers for {len(piece_indices)} pieces"
+                self.update_gui_log(msg, "blue")
+                peers = [(ip, port, base64.b64decode(bitfield)) for ip, port, bitfield in peer_data['peers']]
+                return {index: [[ip, port] for ip, port, bitfield in peers if bitfield_has(bitfield, index)]
+                        for index in piece_indices}
             # msg = f"\033[34mReceived peer-set: \033[0m{peer_data}\033[0m"
             msg = f"Received peer-set: {peer_data}"
             self.update_gui_log(msg, "blue")
@@ -257,112 +1485,292 @@ class Peer(threading.Thread):
             self.update_gui_log(msg, None)
             return {}
 
+    def binary_response(self, msg_type, piece_index, offset, length, payload, conn):
+        if msg_type == MSG_HELLO:
+            conn['codec'] = next((codec for codec in payload if codec in self.compression), CODEC_NONE)
+            return pack_frame(MSG_HELLO, flags=conn['codec']), None
+        elif msg_type == MSG_LENGTH:
+            filename = payload.decode()
+            piece_length = self.piece_store.piece_length(filename, piece_index)
+            return pack_frame(MSG_LENGTH, piece_index, 0, piece_length), None
+        elif msg_type == MSG_BLOCK:
+            filename = payload.decode()
+            piece_length = self.piece_store.piece_length(filename, piece_index)
+            if piece_length == 0 or offset >= piece_length:
+                error_msg = f"Piece {piece_index} not found for file {filename}"
+                self.update_gui_log(error_msg, None)
+                return pack_frame(MSG_ERROR, piece_index, offset, 0, error_msg.encode()), None
+            length = min(length or self.handle_file.block_size, piece_length - offset)
+            block = (filename, piece_index, offset, length)
+            frame = self.compressed_block(conn, block)
+            if frame is not None:
+                return frame, None
+            return pack_frame(MSG_BLOCK, piece_index, offset, length), block
+        elif msg_type == MSG_BITFIELD:
+            filename = payload[:length].decode()
+            sender = (conn['host'], offset)
+            if offset:
+                self.swarm.update(filename, sender, payload[length:])
+            peers = [addr for addr in self.swarm.known(filename) if addr != sender][:self.pex_limit]
+            bitfield = self.piece_store.bitfield(filename)
+            return pack_frame(MSG_BITFIELD, 0, 0, len(bitfield), bytes(bitfield) + pack_peers(peers)), None
+        elif msg_type == MSG_HAVE:
+            self.swarm.have(payload.decode(), (conn['host'], offset), piece_index)
+            return None, None
+        error_msg = f"Unknown message type {msg_type}"
+        return pack_frame(MSG_ERROR, piece_index, offset, 0, error_msg.encode()), None
+
+    def compressed_block(self, conn, block):
+        if not conn['codec']:
+            return None
+        if conn['skip']:
+            conn['skip'] -= 1
+            return None
+        filename, piece_index, offset, length = block
+        data = bytes(self.piece_store.read(*block))
+        packed = CODECS[conn['codec']][0](data)
+        if len(packed) > len(data) * self.compression_ratio:
+            conn['skip'] = conn['backoff']
+            conn['backoff'] = min(conn['backoff'] * 2, self.max_compression_backoff)
+            return pack_frame(MSG_BLOCK, piece_index, offset, length) + data
+        conn['backoff'] = self.compression_backoff
+        return pack_frame(MSG_BLOCK, piece_index, offset, length, packed, flags=conn['codec'])
+
+    def handle_binary_client(self, client_socket):
+        header = bytearray(HEADER.size)
+        conn = {'host': client_socket.getpeername()[0], 'codec': CODEC_NONE, 'skip': 0,
+                'backoff': self.compression_backoff}
+        while True:
+            try:
+                msg_type, flags, piece_index, offset, length, payload_length = \
+                    recv_frame_header(client_socket, header)
+            except (ConnectionError, ValueError):
+                break
+            try:
+                payload = recv_exact(client_socket, payload_length)
+                frame, block = self.binary_response(msg_type, piece_index, offset, length, payload, conn)
+                if frame:
+                    client_socket.sendall(frame)
+                if block:
+                    self.piece_store.send_block(client_socket, *block, self.use_sendfile)
+            except OSError:
+                break
+
     def handle_client(self, client_socket):
         with client_socket:
+            first = client_socket.recv(1, socket.MSG_PEEK)
+            if first and 0 < first[0] < 0x20:
+                self.handle_binary_client(client_socket)
+                return
             while True:
                 data = client_socket.recv(1024).decode()
-                response = 'Response OK'
                 if not data:
                     break
                 parts = data.split()
                 file, cmd = data.rsplit(' ', 1)
                 if (cmd == 'download'):
-                    first_part = file.split('/')[0]
-                    torrent_data = self.get_torrent(first_part)
-                    requested_pieces = self.calculate_piece_indices_for_file(torrent_data, file)
-                    peer_set = self.get_peers_for_pieces(torrent_data['announce'], first_part, requested_pieces)
-                    info = {first_part: {}}
-                    is_success = [True]
-                    threads = []
-                    for piece_index, peer_ips in peer_set.items():
-                        thread = threading.Thread(target=self.request_piece_from_peer,
-                                                  args=(piece_index, peer_ips, first_part, info, is_success))
-                        thread.start()
-                        threads.append(thread)
-                    for thread in threads:
-                        thread.join()
-                    if is_success[0]:
-                        temp = dict(sorted(info[first_part].items()))
-                        temp_hash = ''
-                        for index in temp:
-                            temp_hash += self.handle_file.calculate_sha1(temp[index])
-                        msg = f"Downloaded pieces hash: {temp_hash}"
-                        self.update_gui_log(msg, "blue")
-                        if temp_hash == torrent_data['info']['pieces']:
-                            msg = "Downloaded pieces match the hash in the torrent file."
-                            self.update_gui_log(msg, "blue")
-                            self.files.append(info)
-                            data_update = {
-                                "file_name": first_part,
-                                "pieces_indices": requested_pieces
-                            }
-                            self.update_tracker_download(data_update)
-                            self.reconstruct_file(file, torrent_data)
-                            client_socket.sendall(response.encode())
-                            msg = f"Peer {self.peer_ip}:{self.port} has downloaded: {file}"
-                            self.update_gui_log(msg, "blue")
-                        else:
-                            msg = f"Downloaded pieces do not match the hash in the torrent file."
-                            self.update_gui_log(msg, "red")
-
-                            response = 'Response Failed'
-                            client_socket.sendall(response.encode())
-                    else:
-                        response = 'Response Failed'
-                        msg = f"Failed to download pieces, there seems to be an issue with the peer."
-                        self.update_gui_log(msg, "red")
-                        client_socket.sendall(response.encode())
+                    client_socket.sendall(self.download(file).encode())
                 elif (cmd == 'upload'):
-                    self.handle_file.path = file
-                    res = self.handle_file.divide_file_into_pieces()
-                    self.files.append({res['name']: {str(i): value for i, value in enumerate(res['pieces'])}})
-                    for each in self.files:
-                        for key, value in each.items():
-                            for k, v in value.items():
-                                msg = f"Piece {k} of file {key} has length: {len(v)}"
-                                self.update_gui_log(msg, "blue")
-                    torrent_data = self.handle_file.create_torrent_file(res)
-                    self.update_tracker_upload(torrent_data)
-                    json_str = json.dumps(torrent_data)
-                    self.update_torrent_server(f"{json_str} add")
-                    client_socket.sendall(response.encode())
-                    msg = f"Peer {self.peer_ip}:{self.port} has uploaded: {file}"
-                    self.update_gui_log(msg, "blue")
+                    client_socket.sendall(self.upload(file).encode())
+                elif (cmd == 'queue'):
+                    filename, priority = file.rsplit(' ', 1)
+                    self.queue_download(filename, int(priority))
+                    client_socket.sendall('Response OK'.encode())
                 elif (cmd == 'block'):
                     index, offset = parts[0].split('-')
                     parts = file.split(' ', 1)
                     filename = parts[1]
-                    response = bytearray()
-                    for each in self.files:
-                        if filename in each:
-                            if index in each[filename]:
-                                piece = each[filename].get(index)
-                                piece_length = len(piece)
-                                offset = int(offset)
-                                if (offset < piece_length):
-                                    end = min(offset + self.handle_file.block_size, piece_length)
-                                    response = piece[offset:end]
-                                break
-                            else:
-                                error_msg = f"Piece {index} not found for file {filename}"
-                                self.update_gui_log(error_msg, None)
-                                raise ValueError(f"Piece {index} not found for file {filename}")
-                    client_socket.sendall(response)
+                    piece_length = self.piece_store.piece_length(filename, int(index))
+                    if piece_length == 0:
+                        error_msg = f"Piece {index} not found for file {filename}"
+                        self.update_gui_log(error_msg, None)
+                        raise ValueError(f"Piece {index} not found for file {filename}")
+                    offset = int(offset)
+                    if (offset < piece_length):
+                        end = min(offset + self.handle_file.block_size, piece_length)
+                        self.piece_store.send_block(client_socket, filename, int(index), offset, end - offset,
+                                                    self.use_sendfile)
                 elif (cmd == 'length'):
                     filename, index = file.rsplit(' ', 1)
-                    piece_length = 0
-                    for each in self.files:
-                        if filename in each:
-                            piece = each[filename].get(index)
-                            piece_length = len(piece)
-                            break
+                    piece_length = self.piece_store.piece_length(filename, int(index))
                     client_socket.sendall(str(piece_length).encode())
-                elif (cmd == 'construct'):
-                    self.reconstruct_file(file)
-                    client_socket.sendall('Response OK'.encode())
+
+    def download(self, file):
+        response = 'Response OK'
+        first_part = file.split('/')[0]
+        torrent_data = self.get_torrent(first_part)
+        requested_pieces = self.calculate_piece_indices_for_file(torrent_data, file)
+        files = self.output_files(file, torrent_data)
+        if not files:
+            msg = f"File {file} not found in the provided data."
+            self.update_gui_log(msg, None)
+            return 'Response Failed'
+        writer = PieceWriter(os.path.join(self.OUTPUT_PATH, file.replace('/', '.') + '.bitfield'), files,
+                             torrent_data['info']['piece length'], self.torrent_length(torrent_data),
+                             torrent_data['info']['pieces']).open()
+        missing = [piece_index for piece_index in requested_pieces if not writer.has(piece_index)]
+        resumed = [piece_index for piece_index in requested_pieces if writer.has(piece_index)]
+        self.piece_store.add(first_part, torrent_data['info']['piece length'],
+                             self.torrent_length(torrent_data), files, have=resumed)
+        self.have_batcher.add(first_part, [piece_index for piece_index in resumed
+                                           if self.piece_store.piece_ref(first_part, piece_index)])
+        if len(missing) < len(requested_pieces):
+            msg = (f"Resuming {file}: {len(requested_pieces) - len(missing)} of "
+                   f"{len(requested_pieces)} pieces already downloaded")
+            self.update_gui_log(msg, "blue")
+        peer_set = {}
+        if missing:
+            peer_set = self.get_peers_for_pieces(torrent_data['announce'], first_part, missing)
+        if missing and not peer_set:
+            msg = f"No peers found for {file}, download failed."
+            self.update_gui_log(msg, "red")
+            writer.close()
+            return 'Response Failed'
+        peer_set = {int(index): [tuple(value) for value in peer_ips]
+                    for index, peer_ips in peer_set.items()}
+        peer_set = {piece_index: peer_set.get(piece_index, []) for piece_index in missing}
+        session = self.fetch_pieces(first_part, peer_set, torrent_data['announce'],
+                                    torrent_data['info']['pieces'], writer)
+        success = session.wait() and set(missing) <= session.pieces
+        if session.endgame_requests:
+            msg = (f"Endgame sent {session.endgame_requests} duplicate piece requests, "
+                   f"{session.duplicate_bytes} duplicate bytes received")
+            self.update_gui_log(msg, "blue")
+        if success:
+            if session.corrupt:
+                msg = (f"Re-fetched pieces {sorted(session.corrupt)} of {first_part} "
+                       f"after they did not match the hash in the torrent file")
+                self.update_gui_log(msg, "red")
+            msg = "Downloaded pieces match the hash in the torrent file."
+            self.update_gui_log(msg, "blue")
+            writer.finish()
+            msg = f"File successfully reconstructed and saved to "
+            self.update_gui_log(msg, "blue")
+            msg = files[0][0] if 'length' in torrent_data['info'] or file != first_part else file
+            self.update_gui_log(msg, None)
+            msg = f"Peer {self.peer_ip}:{self.port} has downloaded: {file}"
+            self.update_gui_log(msg, "blue")
+        elif session.corrupt.intersection(session.failed):
+            msg = (f"Downloaded pieces {sorted(session.corrupt.intersection(session.failed))} "
+                   f"do not match the hash in the torrent file.")
+            self.update_gui_log(msg, "red")
+            response = 'Response Failed'
+        else:
+            response = 'Response Failed'
+            msg = f"Failed to download pieces, there seems to be an issue with the peer."
+            self.update_gui_log(msg, "red")
+        writer.close()
+        self.have_batcher.flush(first_part)
+        return response
+
+    def share_piece(self, file, piece_index):
+        if self.piece_store.mark(file, piece_index):
+            self.have_batcher.add(file, [piece_index])
+
+    def announce_pieces(self, file, piece_indices):
+        self.piece_store.flush()
+        with self.tracker_lock:
+            pending = self.tracker_pending.pop(file, set())
+            pending.update(piece_indices)
+        try:
+            self.update_tracker_download({"file_name": file, "pieces_indices": pending})
+        except requests.RequestException as e:
+            with self.tracker_lock:
+                self.tracker_pending.setdefault(file, set()).update(pending)
+            msg = f"Failed to announce pieces of {file} to the tracker: {e}"
+            self.update_gui_log(msg, None)
+        self.announce_have(file, piece_indices)
+
+    def queue_download(self, file, priority=0):
+        self.download_queue.put(file, priority)
+        msg = f"Queued {file} for download with priority {priority}"
+        self.update_gui_log(msg, None)
+
+    def fetch_pieces(self, file, peer_set, announce, piece_hashes, writer):
+        session = DownloadSession(file, peer_set, announce, piece_hashes, writer)
+        if self.engine == 'asyncio':
+            self.loop.call_soon_threadsafe(self.start_task, self.fetch_pieces_async(session))
+        else:
+            for _ in range(min(len(peer_set), self.download_scheduler.workers)):
+                self.download_scheduler.submit(self.download_next_piece, session)
+        return session
+
+    def refresh_availability(self, session, force=False):
+        requested = time.monotonic()
+        if not force and requested - session.refreshed < self.availability_refresh:
+            return
+        if not session.refresh_lock.acquire(blocking=force):
+            return
+        try:
+            if force and session.polled >= requested:
+                return
+            for addr in self.swarm.unknown(session.file):
+                self.meet_peer(session, addr)
+            remaining = session.picker.remaining()
+            if remaining:
+                session.picker.update(self.swarm.sources(session.file, remaining))
+            if session.picker.unavailable() or time.monotonic() - session.polled >= self.tracker_refresh:
+                remaining = session.picker.remaining()
+                if remaining:
+                    peer_set = self.get_peers_for_pieces(session.announce, session.file, remaining)
+                    session.picker.update({int(index): peer_ips for index, peer_ips in peer_set.items()})
+                session.polled = time.monotonic()
+            session.refreshed = time.monotonic()
+        finally:
+            session.refresh_lock.release()
+
+    def settle_unavailable(self, session):
+        self.refresh_availability(session, force=True)
+        for piece_index in session.picker.abandon_unavailable():
+            msg = f"No peer has piece {piece_index} of {session.file}"
+            self.update_gui_log(msg, "red")
+            session.fail(piece_index)
+
+    def download_next_piece(self, session):
+        while True:
+            self.refresh_availability(session)
+            piece_index, peer_ips = session.picker.pick()
+            if piece_index is None and session.picker.unavailable():
+                self.settle_unavailable(session)
+                piece_index, peer_ips = session.picker.pick()
+            if piece_index is None:
+                piece_index, peer_ips = session.endgame_pick(self.endgame_threshold)
+            if piece_index is None:
+                return
+            self.request_piece_from_peer(piece_index, peer_ips, session.file, session)
+
+    def upload(self, file):
+        self.handle_file.path = file
+        res = self.handle_file.divide_file_into_pieces(stream=True)
+        files = []
+        current_offset = 0
+        for file_path, file_size in res['sources']:
+            files.append((file_path, current_offset, file_size))
+            current_offset += file_size
+        self.piece_store.add(res['name'], self.handle_file.piece_size, current_offset, files)
+        for k in range(len(res['piece_hashes'])):
+            msg = f"Piece {k} of file {res['name']} has length: {self.piece_store.piece_length(res['name'], k)}"
+            self.update_gui_log(msg, "blue")
+        torrent_data = self.handle_file.create_torrent_file(res)
+        self.update_tracker_upload(torrent_data)
+        json_str = json.dumps(torrent_data)
+        self.update_torrent_server(f"{json_str} add")
+        msg = f"Peer {self.peer_ip}:{self.port} has uploaded: {file}"
+        self.update_gui_log(msg, "blue")
+        return 'Response OK'
 
     def stop(self):
         self.running = False
+        self.stopped.set()
+        self.download_scheduler.stop()
+        self.download_queue.stop()
+        self.have_batcher.stop()
+        self.announce_stopped()
+        self.connection_pool.close()
+        if self.engine == 'asyncio':
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.async_server.close)
+            return
         temp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         temp_socket.connect((self.peer_ip, self.port))
         temp_socket.close()
@@ -380,131 +1788,427 @@ class Peer(threading.Thread):
         pprint.pprint(torrent)
         return torrent
 
-    def request_block_from_peer(self, piece_index, block_offset, peer_ips, file, index, blocks, info):
-        temp = peer_ips
+    def handshake(self, sock, addr):
+        send_frame(sock, MSG_HELLO, payload=bytes(self.compression))
+        first = sock.recv(1)
+        if not first:
+            self.peer_protocols[addr] = 0
+            raise ConnectionError(f"Peer {addr} closed the connection instead of answering the hello")
+        msg_type, flags, piece_index, offset, length, payload_length = \
+            unpack_frame_header(first + recv_exact(sock, HEADER.size - 1))
+        recv_exact(sock, payload_length)
+        self.peer_protocols[addr] = PROTOCOL_VERSION if msg_type == MSG_HELLO else 0
 
+    def request_from_peer(self, addr, exchange):
+        addr = tuple(addr)
         while True:
-            value = random.choice(temp)
+            sock, reused = self.connection_pool.acquire(addr)
+            if not reused and self.peer_protocols.get(addr, PROTOCOL_VERSION):
+                try:
+                    self.handshake(sock, addr)
+                except (OSError, ValueError):
+                    self.connection_pool.discard(addr, sock)
+                    if self.peer_protocols.get(addr) == 0:
+                        continue
+                    raise
             try:
-                peer_ip, peer_port = value
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((peer_ip, peer_port))
-                sock.sendall(f"{piece_index}-{block_offset} {file} block".encode())
-                response = sock.recv(self.handle_file.block_size)
-                sock.close()
-                blocks[index] = response
-                break
-            except:
+                response = exchange(sock, self.peer_protocols.get(addr, 0))
+            except OSError:
+                self.connection_pool.discard(addr, sock)
+                if reused:
+                    continue
+                raise
+            except Exception:
+                self.connection_pool.discard(addr, sock)
+                raise
+            self.connection_pool.release(addr, sock)
+            return response
+
+    def bitfield_frame(self, file):
+        name = file.encode()
+        return pack_frame(MSG_BITFIELD, 0, self.port, len(name), name + bytes(self.piece_store.bitfield(file)))
+
+    def meet_peer(self, session, addr):
+        if tuple(addr) == (self.peer_ip, self.port) or not session.meet(addr):
+            return
+        try:
+            self.exchange_bitfield(addr, session.file)
+        except Exception as e:
+            self.forget_peer(session.file, addr, e)
+
+    def forget_peer(self, file, addr, error):
+        msg = f"Failed to exchange bitfield of {file} with {addr}: {error}"
+        self.update_gui_log(msg, None)
+        self.swarm.remove(file, addr)
+
+    def learn_bitfield(self, addr, file, msg_type, length, payload):
+        if msg_type != MSG_BITFIELD:
+            raise ValueError(payload.decode())
+        self.swarm.update(file, addr, payload[:length])
+        for value in unpack_peers(payload[length:]):
+            if value != (self.peer_ip, self.port):
+                self.swarm.add(file, value)
+
+    def exchange_bitfield(self, addr, file):
+        def exchange(sock, version):
+            if not version:
+                return
+            sock.sendall(self.bitfield_frame(file))
+            msg_type, flags, index, offset, length, payload_length = \
+                recv_frame_header(sock, bytearray(HEADER.size))
+            self.learn_bitfield(addr, file, msg_type, length, recv_exact(sock, payload_length))
+        return self.request_from_peer(addr, exchange)
+
+    def announce_have(self, file, piece_indices):
+        frames = b''.join(pack_frame(MSG_HAVE, piece_index, self.port, 0, file.encode())
+                          for piece_index in piece_indices)
+        def exchange(sock, version):
+            if version:
+                sock.sendall(frames)
+        for addr in self.swarm.known(file):
+            if addr == (self.peer_ip, self.port):
+                continue
+            try:
+                self.request_from_peer(addr, exchange)
+            except Exception as e:
+                msg = f"Failed to announce pieces of {file} to {addr}: {e}"
+                self.update_gui_log(msg, None)
+                self.swarm.remove(file, addr)
+
+    def request_block(self, addr, file, piece_index, block_offset, block_length):
+        def exchange(sock, version):
+            if version:
+                send_frame(sock, MSG_BLOCK, int(piece_index), block_offset, block_length, file.encode())
+                msg_type, flags, index, offset, length, payload_length = \
+                    recv_frame_header(sock, bytearray(HEADER.size))
+                if msg_type != MSG_BLOCK:
+                    raise ValueError(recv_exact(sock, payload_length).decode())
+                if flags:
+                    return decompress_block(flags, recv_exact(sock, payload_length), length)
+                return recv_exact(sock, length)
+            sock.sendall(f"{piece_index}-{block_offset} {file} block".encode())
+            return recv_exact(sock, block_length)
+        return self.request_from_peer(addr, exchange)
+
+    def observe_rtt(self, addr, rtt):
+        self.pipeline_window(addr).observe_rtt(rtt)
+        self.peer_scores.record_latency(tuple(addr), rtt)
+
+    def claim_batch(self, session, piece_index, addr):
+        blocks_per_piece = math.ceil(session.piece_size(piece_index) / self.handle_file.block_size)
+        extra = math.ceil(self.pipeline_window(addr).size / max(blocks_per_piece, 1)) - 1
+        batch = [piece_index] + (session.picker.claim(addr, extra) if extra > 0 else [])
+        for index in batch[1:]:
+            session.start_fetch(index, addr)
+        return batch
+
+    def batch_blocks(self, session, batch):
+        wanted = []
+        for piece_index in batch:
+            piece_size = session.piece_size(piece_index)
+            for block_offset in range(0, piece_size, self.handle_file.block_size):
+                wanted.append((piece_index, block_offset, min(self.handle_file.block_size, piece_size - block_offset)))
+        return wanted
+
+    def complete_batch(self, session, file, batch, wanted, blocks, addr):
+        pieces = {piece_index: bytearray() for piece_index in batch}
+        for piece_index, block_offset, block_length in wanted:
+            pieces[piece_index].extend(blocks[(piece_index, block_offset)])
+        verified = True
+        for piece_index in reversed(batch):
+            if not session.verify(piece_index, pieces[piece_index]):
+                if piece_index == batch[0]:
+                    raise ValueError("piece does not match the hash in the torrent file")
+                self.update_gui_log(f"Piece {piece_index} of {file} from {addr} does not match the hash in "
+                                    f"the torrent file", None)
+                self.peer_scores.record_failure(addr)
+                verified = False
+                continue
+            if session.complete(piece_index, pieces[piece_index]):
+                self.share_piece(file, piece_index)
+        return verified
+
+    def release_batch(self, session, batch, addr):
+        for piece_index in batch:
+            session.finish_fetch(piece_index, addr)
+        for piece_index in batch[1:]:
+            if not session.is_complete(piece_index):
+                session.picker.release(piece_index)
+
+    def pipeline_window(self, addr):
+        return self.pipeline_windows.setdefault(tuple(addr), PipelineWindow(self.pipeline_depth,
+                                                                            self.max_pipeline_depth))
+
+    def request_blocks(self, addr, file, wanted, cancelled=None):
+        window = self.pipeline_window(addr)
+
+        def exchange(sock, version):
+            depth = window.size if version else 1
+            blocks = {}
+            queue = deque(wanted)
+            pending = deque()
+            header = bytearray(HEADER.size)
+            transferred = 0
+            start = time.monotonic()
+            replied = False
+            while queue or pending:
+                if cancelled is not None and cancelled():
+                    raise DownloadCancelled(transferred)
+                while queue and len(pending) < depth:
+                    piece_index, block_offset, block_length = queue.popleft()
+                    if version:
+                        send_frame(sock, MSG_BLOCK, int(piece_index), block_offset, block_length, file.encode())
+                    else:
+                        sock.sendall(f"{piece_index}-{block_offset} {file} block".encode())
+                    pending.append((piece_index, block_offset, block_length))
+                piece_index, block_offset, block_length = pending.popleft()
+                if version:
+                    msg_type, flags, reply_index, offset, length, payload_length = recv_frame_header(sock, header)
+                    if not replied:
+                        replied = True
+                        self.observe_rtt(addr, time.monotonic() - start)
+                    if msg_type != MSG_BLOCK:
+                        raise ValueError(recv_exact(sock, payload_length).decode())
+                    if flags:
+                        blocks[(piece_index, block_offset)] = decompress_block(
+                            flags, recv_exact(sock, payload_length), length)
+                        transferred += payload_length
+                        continue
+                    block_length = length
+                blocks[(piece_index, block_offset)] = recv_exact(sock, block_length)
+                transferred += block_length
+            window.observe_transfer(transferred, time.monotonic() - start, self.handle_file.block_size)
+            return blocks
+
+        try:
+            return self.request_from_peer(addr, exchange)
+        except DownloadCancelled:
+            raise
+        except Exception:
+            window.shrink()
+            raise
+
+    def request_piece_from_peer(self, piece_index, peer_ips, file, session):
+        temp = list(peer_ips)
+        while temp and not session.is_complete(piece_index):
+            value = self.download_scheduler.acquire_peer(temp, self.peer_scores.choose)
+            session.start_fetch(piece_index, value)
+            batch = [piece_index]
+            try:
+                if value not in session.met:
+                    self.meet_peer(session, value)
+                batch = self.claim_batch(session, piece_index, value)
+                wanted = self.batch_blocks(session, batch)
+                start = time.monotonic()
+                blocks = self.request_blocks(value, file, wanted,
+                                             lambda: all(session.is_complete(index) for index in batch))
+                elapsed = time.monotonic() - start
+                if self.complete_batch(session, file, batch, wanted, blocks, value):
+                    self.peer_scores.record_transfer(value, sum(length for index, offset, length in wanted),
+                                                     elapsed)
+                return
+            except DownloadCancelled as e:
+                session.cancelled(e.transferred)
+                return
+            except Exception as e:
+                msg = f"Failed to get piece {piece_index} of {file} from {value}: {e}"
+                self.update_gui_log(msg, None)
+                self.peer_scores.record_failure(value)
                 with suppress(ValueError):
                     temp.remove(value)
-                if len(temp) == 0:
-                    info['is_success'] = False
-                    break
+            finally:
+                self.release_batch(session, batch, value)
+                self.download_scheduler.release_peer(value)
+        session.fail(piece_index)
+
+    async def handshake_async(self, reader, writer, addr):
+        writer.write(pack_frame(MSG_HELLO, payload=bytes(self.compression)))
+        await writer.drain()
+        first = await reader.read(1)
+        if not first:
+            self.peer_protocols[addr] = 0
+            raise ConnectionError(f"Peer {addr} closed the connection instead of answering the hello")
+        msg_type, flags, piece_index, offset, length, payload_length = \
+            unpack_frame_header(first + await reader.readexactly(HEADER.size - 1))
+        await reader.readexactly(payload_length)
+        self.peer_protocols[addr] = PROTOCOL_VERSION if msg_type == MSG_HELLO else 0
 
-    def request_piece_from_peer(self, piece_index, peer_ips, file, piece_info, is_success):
-        piece_size = 0
-        temp = peer_ips
+    async def request_from_peer_async(self, addr, exchange):
+        addr = tuple(addr)
         while True:
-            value = random.choice(temp)
+            reader, writer, reused = await self.async_pool.acquire(addr)
+            if not reused and self.peer_protocols.get(addr, PROTOCOL_VERSION):
+                try:
+                    await asyncio.wait_for(self.handshake_async(reader, writer, addr), self.async_pool.read_timeout)
+                except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    self.async_pool.discard(addr, writer)
+                    if self.peer_protocols.get(addr) == 0:
+                        continue
+                    raise
+                except BaseException:
+                    self.async_pool.discard(addr, writer)
+                    raise
             try:
-                peer_ip, peer_port = value
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((peer_ip, peer_port))
-                sock.sendall(f"{file} {piece_index} length".encode())
-                piece_size = sock.recv(1024)
-                sock.close()
-                if (piece_size):
-                    break
-                else:
-                    with suppress(ValueError):
-                        temp.remove(value)
-                    if len(temp) == 0:
-                        return {'is_success': False}
-            except:
+                response = await asyncio.wait_for(exchange(reader, writer, self.peer_protocols.get(addr, 0)),
+                                                  self.async_pool.read_timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                self.async_pool.discard(addr, writer)
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                self.async_pool.discard(addr, writer)
+                raise
+            self.async_pool.release(addr, reader, writer)
+            return response
+
+    async def meet_peer_async(self, session, addr):
+        if tuple(addr) == (self.peer_ip, self.port) or not session.meet(addr):
+            return
+        try:
+            await self.exchange_bitfield_async(addr, session.file)
+        except Exception as e:
+            self.forget_peer(session.file, addr, e)
+
+    async def exchange_bitfield_async(self, addr, file):
+        async def exchange(reader, writer, version):
+            if not version:
+                return
+            writer.write(self.bitfield_frame(file))
+            await writer.drain()
+            msg_type, flags, index, offset, length, payload_length = \
+                unpack_frame_header(await reader.readexactly(HEADER.size))
+            self.learn_bitfield(addr, file, msg_type, length, await reader.readexactly(payload_length))
+        return await self.request_from_peer_async(addr, exchange)
+
+    async def request_blocks_async(self, addr, file, wanted, cancelled=None):
+        window = self.pipeline_window(addr)
+
+        async def exchange(reader, writer, version):
+            depth = window.size if version else 1
+            blocks = {}
+            queue = deque(wanted)
+            pending = deque()
+            transferred = 0
+            start = time.monotonic()
+            replied = False
+            while queue or pending:
+                if cancelled is not None and cancelled():
+                    raise DownloadCancelled(transferred)
+                while queue and len(pending) < depth:
+                    piece_index, block_offset, block_length = queue.popleft()
+                    if version:
+                        writer.write(pack_frame(MSG_BLOCK, int(piece_index), block_offset, block_length,
+                                                file.encode()))
+                    else:
+                        writer.write(f"{piece_index}-{block_offset} {file} block".encode())
+                    pending.append((piece_index, block_offset, block_length))
+                await writer.drain()
+                piece_index, block_offset, block_length = pending.popleft()
+                if version:
+                    msg_type, flags, reply_index, offset, length, payload_length = \
+                        unpack_frame_header(await reader.readexactly(HEADER.size))
+                    if not replied:
+                        replied = True
+                        self.observe_rtt(addr, time.monotonic() - start)
+                    if msg_type != MSG_BLOCK:
+                        raise ValueError((await reader.readexactly(payload_length)).decode())
+                    if flags:
+                        blocks[(piece_index, block_offset)] = decompress_block(
+                            flags, await reader.readexactly(payload_length), length)
+                        transferred += payload_length
+                        continue
+                    block_length = length
+                blocks[(piece_index, block_offset)] = await reader.readexactly(block_length)
+                transferred += block_length
+            window.observe_transfer(transferred, time.monotonic() - start, self.handle_file.block_size)
+            return blocks
+
+        try:
+            return await self.request_from_peer_async(addr, exchange)
+        except DownloadCancelled:
+            raise
+        except Exception:
+            window.shrink()
+            raise
+
+    async def request_piece_async(self, piece_index, peer_ips, file, session):
+        temp = list(peer_ips)
+        while temp and not session.is_complete(piece_index):
+            value = self.peer_scores.choose(temp)
+            session.start_fetch(piece_index, value)
+            batch = [piece_index]
+            try:
+                if value not in session.met:
+                    await self.meet_peer_async(session, value)
+                batch = self.claim_batch(session, piece_index, value)
+                wanted = self.batch_blocks(session, batch)
+                start = time.monotonic()
+                blocks = await self.request_blocks_async(value, file, wanted,
+                                                         lambda: all(session.is_complete(index) for index in batch))
+                elapsed = time.monotonic() - start
+                if await self.loop.run_in_executor(self.io_executor, self.complete_batch, session, file, batch,
+                                                   wanted, blocks, value):
+                    self.peer_scores.record_transfer(value, sum(length for index, offset, length in wanted),
+                                                     elapsed)
+                return
+            except DownloadCancelled as e:
+                session.cancelled(e.transferred)
+                return
+            except Exception as e:
+                msg = f"Failed to get piece {piece_index} of {file} from {value}: {e}"
+                self.update_gui_log(msg, None)
+                self.peer_scores.record_failure(value)
                 with suppress(ValueError):
                     temp.remove(value)
-                if len(temp) == 0:
-                    return {'is_success': False}
-        piece = bytearray()
-        blocks = {}
-        block_offset = 0
-        info = {'is_success': True}
-        num = math.ceil(int(piece_size.decode()) / self.handle_file.block_size)
-        pool = []
-        for index in range(num):
-            block_offset = index * self.handle_file.block_size
-            thread = threading.Thread(target=self.request_block_from_peer,
-                                      args=(piece_index, block_offset, peer_ips, file, index, blocks, info))
-            thread.start()
-            pool.append(thread)
-
-        for thread in pool:
-            thread.join()
-
-        blocks = dict(sorted(blocks.items()))
-        for index in blocks:
-            piece.extend(blocks[index])
-        info['piece'] = piece
-        is_success[0] = info['is_success']
-        piece_info[file][piece_index] = piece
-
-    def reconstruct_file(self, target_filename, torrent_data):
-        root = target_filename.split('/')[0]
+            finally:
+                self.release_batch(session, batch, value)
+        session.fail(piece_index)
 
-        for file_dict in self.files:
-            if root in file_dict:
-                pieces = file_dict[root]
-                sorted_piece_keys = sorted(pieces.keys(), key=int)
-                complete_file_data = bytearray()
-                for key in sorted_piece_keys:
-                    complete_file_data.extend(pieces[key])
-                if not os.path.exists(self.OUTPUT_PATH):
-                    os.makedirs(self.OUTPUT_PATH)
-                if ('length' in torrent_data['info']):
-                    output_path = os.path.join(self.OUTPUT_PATH, root)
-                    with open(output_path, 'wb') as file:
-                        file.write(complete_file_data)
-                    msg = f"File successfully reconstructed and saved to "
-                    self.update_gui_log(msg, "blue")
-                    msg = output_path
-                    self.update_gui_log(msg, None)
-                else:
-                    name = torrent_data['info']['name']
-                    files = torrent_data['info']['files']
-                    for file_info in files:
-                        file_path = os.path.join(*file_info['path'])
-                        if target_filename == file_path:
-                            dirs = file_info['path'][:-1]
-                            output_dir = os.path.join(*dirs)
-                            os.makedirs(output_dir, exist_ok=True)
-                            output_path = os.path.join(self.OUTPUT_PATH, file_info['path'][-1])
-                            with open(output_path, 'wb') as file:
-                                start = file_info['mapping']['start_offset']
-                                end = file_info['mapping']['end_offset']
-                                file.write(complete_file_data[start:end])
-                            msg = f"File successfully reconstructed and saved to "
-                            self.update_gui_log(msg, "blue")
-                            msg = output_path
-                            self.update_gui_log(msg, None)
-                            return
-                    if target_filename == name:
-                        for file_info in files:
-                            dirs = file_info['path'][:-1]
-                            output_dir = os.path.join(self.OUTPUT_PATH, *dirs)
-                            os.makedirs(output_dir, exist_ok=True)
-                            output_path = os.path.join(output_dir, file_info['path'][-1])
-                            with open(output_path, 'wb') as file:
-                                start = file_info['mapping']['start_offset']
-                                end = file_info['mapping']['end_offset']
-                                file.write(complete_file_data[start:end])
-                        msg = f"File successfully reconstructed and saved to "
-                        self.update_gui_log(msg, "blue")
-                        msg = target_filename
-                        self.update_gui_log(msg, None)
+    async def download_next_piece_async(self, session):
+        async with self.async_slots:
+            while True:
+                if time.monotonic() - session.refreshed >= self.availability_refresh:
+                    await self.loop.run_in_executor(self.io_executor, self.refresh_availability, session)
+                piece_index, peer_ips = session.picker.pick()
+                if piece_index is None and session.picker.unavailable():
+                    await self.loop.run_in_executor(self.io_executor, self.settle_unavailable, session)
+                    piece_index, peer_ips = session.picker.pick()
+                if piece_index is None:
+                    piece_index, peer_ips = session.endgame_pick(self.endgame_threshold)
+                if piece_index is None:
+                    return
+                await self.request_piece_async(piece_index, peer_ips, session.file, session)
 
-                return
-        msg = f"File {target_filename} not found in the provided data."
-        self.update_gui_log(msg, None)
+    def start_task(self, coro):
+        task = self.loop.create_task(coro)
+        self.async_tasks.add(task)
+        task.add_done_callback(self.async_tasks.discard)
+
+    async def fetch_pieces_async(self, session):
+        workers = min(session.remaining, self.async_concurrency)
+        await asyncio.gather(*(self.download_next_piece_async(session) for _ in range(workers)))
+
+    def torrent_length(self, torrent_data):
+        if 'length' in torrent_data['info']:
+            return torrent_data['info']['length']
+        return sum(file['length'] for file in torrent_data['info']['files'])
+
+    def output_files(self, target_filename, torrent_data):
+        root = target_filename.split('/')[0]
+        if 'length' in torrent_data['info']:
+            if target_filename != root:
+                return []
+            return [(os.path.join(self.OUTPUT_PATH, root), 0, torrent_data['info']['length'])]
+        files = []
+        for file_info in torrent_data['info']['files']:
+            file_path = '/'.join(file_info['path'])
+            start = file_info['mapping']['start_offset']
+            if target_filename == file_path:
+                return [(os.path.join(self.OUTPUT_PATH, file_info['path'][-1]), start, file_info['length'])]
+            if target_filename == torrent_data['info']['name']:
+                files.append((os.path.join(self.OUTPUT_PATH, *file_info['path']), start, file_info['length']))
+        return files
 
     def update_torrent_server(self, data):
         peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1,10 +1,320 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
 from urllib.parse import urlparse, parse_qs
+from contextlib import suppress
 import socket
+import threading
+import base64
+import os
+import time
+
+# upper bound on piece indices accepted from clients, 2 MiB of bitfield per peer and file
+MAX_PIECES = 1 << 24
+
+def pieces_to_bitfield(piece_indices):
+    if piece_indices and not 0 <= min(piece_indices) <= max(piece_indices) < MAX_PIECES:
+        raise ValueError(f"Piece indices must be between 0 and {MAX_PIECES - 1}")
+    bitfield = bytearray(max(piece_indices) // 8 + 1 if piece_indices else 0)
+    for index in piece_indices:
+        bitfield[index // 8] |= 0x80 >> index % 8
+    return bitfield
+
+def ranges_to_bitfield(ranges):
+    for start, end in ranges:
+        if start < 0 or end < start or end >= MAX_PIECES:
+            raise ValueError(f"Invalid piece range {start}-{end}")
+    bitfield = bytearray(max((end for start, end in ranges), default=-1) // 8 + 1)
+    for start, end in ranges:
+        head = min(end + 1, (start + 7) // 8 * 8)
+        tail = max(head, (end + 1) // 8 * 8)
+        for index in list(range(start, head)) + list(range(tail, end + 1)):
+            bitfield[index // 8] |= 0x80 >> index % 8
+        bitfield[head // 8:tail // 8] = b'\xff' * (tail // 8 - head // 8)
+    return bitfield
+
+def parse_ranges(text):
+    ranges = []
+    for part in text.split(','):
+        start, _, end = part.partition('-')
+        start, end = int(start), int(end or start)
+        if start < 0 or end < start:
+            raise ValueError(f"Invalid piece range {start}-{end}")
+        ranges.append((start, end))
+    return ranges
+
+def decode_pieces(data):
+    if 'pieces_bitfield' in data:
+        bitfield = bytearray(base64.b64decode(data['pieces_bitfield']))
+        if len(bitfield) > MAX_PIECES // 8:
+            raise ValueError(f"Piece bitfield longer than {MAX_PIECES // 8} bytes")
+        return bitfield
+    if 'pieces_ranges' in data:
+        return ranges_to_bitfield(data['pieces_ranges'])
+    return pieces_to_bitfield(data['pieces_indices'])
+
+def merge_bitfields(first, second):
+    length = max(len(first), len(second))
+    merged = int.from_bytes(first.ljust(length, b'\0'), 'big') | int.from_bytes(second.ljust(length, b'\0'), 'big')
+    return bytearray(merged.to_bytes(length, 'big'))
+
+def bitfield_has(bitfield, index):
+    return index // 8 < len(bitfield) and bool(bitfield[index // 8] & (0x80 >> index % 8))
+
+def encode_bitfield(bitfield):
+    offset = len(bitfield) - len(bytes(bitfield).lstrip(b'\0'))
+    return offset, base64.b64encode(bytes(bitfield[offset:])).decode()
+
+def decode_bitfield(offset, data):
+    return bytearray(offset) + base64.b64decode(data)
+
+def merge_announce(registry, file_name, peer, bitfield, file_details=None):
+    entry = registry.setdefault(file_name, {"peers": {}, "seen": {}, "files_nested": []})
+    peers = entry["peers"]
+    peers[peer] = merge_bitfields(peers[peer], bitfield) if peer in peers else bitfield
+    entry["seen"][peer] = time.monotonic()
+    if file_details:
+        entry['files_nested'] = file_details
+    return peers
+
+def forget_peer(registry, file_name, peer):
+    entry = registry.get(file_name)
+    if entry is None or peer not in entry["peers"]:
+        return False
+    del entry["peers"][peer]
+    entry["seen"].pop(peer, None)
+    if not entry["peers"] and not entry["files_nested"]:
+        del registry[file_name]
+    return True
+
+class TrackerJournal:
+    def __init__(self, directory, snapshot_interval=60.0, snapshot_records=10000):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, 'tracker-snapshot.json')
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_records = snapshot_records
+        self.generation = 0
+        self.records = 0
+        self.log = None
+        self.lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def log_path(self, generation):
+        return os.path.join(self.directory, f'tracker-log-{generation}.jsonl')
+
+    def log_generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith('tracker-log-') and name.endswith('.jsonl'):
+                with suppress(ValueError):
+                    generations.append(int(name[len('tracker-log-'):-len('.jsonl')]))
+        return sorted(generations)
+
+    def restore(self, registry):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            self.generation = snapshot['generation']
+            now = time.monotonic()
+            for file_name, entry in snapshot['files'].items():
+                peers = {(ip, port): decode_bitfield(offset, bitfield)
+                         for ip, port, offset, bitfield in entry['peers']}
+                registry[file_name] = {
+                    "peers": peers,
+                    "seen": dict.fromkeys(peers, now),
+                    "files_nested": entry['files_nested']
+                }
+        replayed = 0
+        for generation in self.log_generations():
+            if generation < self.generation:
+                os.remove(self.log_path(generation))
+                continue
+            with open(self.log_path(generation), 'rb+') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        f.truncate(offset)
+                        break
+                    offset += len(line)
+                    if record.get('stopped'):
+                        forget_peer(registry, record['file'], tuple(record['peer']))
+                    else:
+                        merge_announce(registry, record['file'], tuple(record['peer']),
+                                       decode_bitfield(record['offset'], record['bitfield']),
+                                       record.get('files_nested'))
+                    replayed += 1
+            self.generation = max(self.generation, generation)
+        self.records = replayed
+        self.log = open(self.log_path(self.generation), 'ab')
+        return replayed
+
+    def append(self, file_name, peer, bitfield, file_details=None):
+        offset, data = encode_bitfield(bitfield)
+        record = {'file': file_name, 'peer': list(peer), 'offset': offset, 'bitfield': data}
+        if file_details:
+            record['files_nested'] = file_details
+        self.write(record)
+
+    def remove(self, file_name, peer):
+        self.write({'file': file_name, 'peer': list(peer), 'stopped': True})
+
+    def write(self, record):
+        line = (json.dumps(record) + '\n').encode()
+        with self.lock:
+            self.log.write(line)
+            self.log.flush()
+            self.records += 1
+            if self.records >= self.snapshot_records:
+                self.wakeup.set()
+
+    def snapshot(self, tracker):
+        with self.snapshot_lock:
+            with self.lock:
+                self.log.close()
+                self.generation += 1
+                self.records = 0
+                self.log = open(self.log_path(self.generation), 'ab')
+            with tracker.registry_lock:
+                file_names = list(tracker.registry)
+            files = {}
+            for file_name in file_names:
+                with tracker.file_lock(file_name):
+                    entry = tracker.registry.get(file_name)
+                    if entry is None:
+                        continue
+                    peers = list(entry['peers'].items())
+                    files_nested = entry['files_nested']
+                files[file_name] = {
+                    'files_nested': files_nested,
+                    'peers': [[ip, port, *encode_bitfield(bitfield)] for (ip, port), bitfield in peers]
+                }
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({'generation': self.generation, 'files': files}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            for generation in self.log_generations():
+                if generation < self.generation:
+                    os.remove(self.log_path(generation))
+
+    def start(self, tracker):
+        self.thread = threading.Thread(target=self.work, args=(tracker,), daemon=True)
+        self.thread.start()
+
+    def work(self, tracker):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.snapshot_interval)
+            self.wakeup.clear()
+            if self.records:
+                self.snapshot(tracker)
+
+    def stop(self, tracker):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.records:
+            self.snapshot(tracker)
+        with self.lock:
+            self.log.close()
+
+class ThreadingTrackerServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
 
 class TrackerHTTPServer(BaseHTTPRequestHandler):
     registry = {}
+    file_locks = {}
+    registry_lock = threading.Lock()
+    journal = None
+    peer_ttl = 120.0
+
+    @classmethod
+    def file_lock(cls, file_name):
+        lock = cls.file_locks.get(file_name)
+        if lock is None:
+            with cls.registry_lock:
+                lock = cls.file_locks.setdefault(file_name, threading.Lock())
+        return lock
+
+    def announce(self, file_name, peer, bitfield, file_details=None):
+        with self.file_lock(file_name):
+            if file_name not in self.registry:
+                with self.registry_lock:
+                    self.registry[file_name] = {
+                        "peers": {},
+                        "seen": {},
+                        "files_nested": []
+                    }
+            peers = merge_announce(self.registry, file_name, peer, bitfield, file_details)
+            if self.journal is not None:
+                self.journal.append(file_name, peer, bitfield, file_details)
+            count = bin(int.from_bytes(bitfield, 'big')).count('1')
+            print(f"{file_name}: {count} pieces announced by {peer[0]}:{peer[1]}, "
+                  f"{len(peers)} peers tracked")
+
+    def heartbeat(self, peer, file_names):
+        unknown = []
+        now = time.monotonic()
+        for file_name in file_names:
+            with self.file_lock(file_name):
+                entry = self.registry.get(file_name)
+                if entry is None or peer not in entry['peers']:
+                    unknown.append(file_name)
+                else:
+                    entry['seen'][peer] = now
+        return unknown
+
+    @classmethod
+    def forget(cls, file_name, peer):
+        with cls.file_lock(file_name):
+            return cls.drop(file_name, peer)
+
+    @classmethod
+    def drop(cls, file_name, peer):
+        with cls.registry_lock:
+            removed = forget_peer(cls.registry, file_name, peer)
+        if removed and cls.journal is not None:
+            cls.journal.remove(file_name, peer)
+        return removed
+
+    @classmethod
+    def expire(cls):
+        with cls.registry_lock:
+            file_names = list(cls.registry)
+        now = time.monotonic()
+        expired = 0
+        for file_name in file_names:
+            with cls.file_lock(file_name):
+                entry = cls.registry.get(file_name, {'seen': {}})
+                stale = [peer for peer, seen in entry['seen'].items() if now - seen > cls.peer_ttl]
+                for peer in stale:
+                    expired += cls.drop(file_name, peer)
+        if expired:
+            print(f"Expired {expired} stale peer entries")
+        return expired
+
+    @classmethod
+    def expire_loop(cls):
+        while True:
+            time.sleep(cls.peer_ttl / 4)
+            cls.expire()
+
+    @classmethod
+    def live_peers(cls, file_name):
+        with cls.file_lock(file_name):
+            entry = cls.registry.get(file_name, {'peers': {}, 'seen': {}})
+            now = time.monotonic()
+            return [(peer, bitfield) for peer, bitfield in entry['peers'].items()
+                    if now - entry['seen'].get(peer, now) <= cls.peer_ttl]
 
     def do_POST(self):
         if self.path == '/peer-update':
@@ -15,26 +325,18 @@ class TrackerHTTPServer(BaseHTTPRequestHandler):
             file_name = data['file_name']
             peer_ip = data['peer_ip']
             peer_port = data['peer_port']
-            pieces_indices = data['pieces_indices']
             file_details = data.get('file_details', None)
-            if file_name not in self.registry:
-                self.registry[file_name] = {
-                    "piece_indices": {},
-                    "files_nested": []
-                }
-            for index in pieces_indices:
-                if index not in self.registry[file_name]["piece_indices"]:
-                    self.registry[file_name]["piece_indices"][index] = []
-                if (peer_ip, peer_port) not in self.registry[file_name]["piece_indices"][index]:
-                    self.registry[file_name]["piece_indices"][index].append((peer_ip, peer_port))
-            if file_details:
-                self.registry[file_name]['files_nested'] = file_details
+            try:
+                bitfield = decode_pieces(data)
+            except ValueError:
+                self.send_error(400, "Invalid pieces")
+                return
+            self.announce(file_name, (peer_ip, peer_port), bitfield, file_details)
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             response = {"message": "Update successful"}
             self.wfile.write(json.dumps(response).encode())
-            print(self.registry)
         elif self.path == '/peer-update-download':
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
@@ -43,16 +345,47 @@ class TrackerHTTPServer(BaseHTTPRequestHandler):
             peer_ip = data['peer_ip']
             peer_port = data['peer_port']
             file_name = data['file_name']
-            pieces_indices = data['pieces_indices']
-            for index in pieces_indices:
-                if (peer_ip, peer_port) not in self.registry[file_name]["piece_indices"][index]:
-                    self.registry[file_name]["piece_indices"][index].append((peer_ip, peer_port))
+            try:
+                bitfield = decode_pieces(data)
+            except ValueError:
+                self.send_error(400, "Invalid pieces")
+                return
+            self.announce(file_name, (peer_ip, peer_port), bitfield)
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             response = {"message": "Update successful"}
             self.wfile.write(json.dumps(response).encode())
-            print(self.registry)
+        elif self.path == '/heartbeat':
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode())
+
+            peer = (data['peer_ip'], data['peer_port'])
+            unknown = self.heartbeat(peer, data.get('file_names', []))
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({"unknown": unknown}).encode())
+        elif self.path == '/peer-stopped':
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode())
+
+            peer = (data['peer_ip'], data['peer_port'])
+            file_names = data.get('file_names')
+            if file_names is None:
+                with self.registry_lock:
+                    file_names = list(self.registry)
+            removed = sum(self.forget(file_name, peer) for file_name in file_names)
+            print(f"{peer[0]}:{peer[1]} stopped, removed from {removed} files")
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            response = {"message": "Stop successful"}
+            self.wfile.write(json.dumps(response).encode())
+        else:
+            self.send_error(404, "File Not Found")
 
     def do_GET(self):
         if self.path == '/show':
@@ -60,24 +393,35 @@ class TrackerHTTPServer(BaseHTTPRequestHandler):
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             temp = []
-            for key in self.registry.keys():
-                if (len(self.registry[key]['files_nested'])):
-                    for each in self.registry[key]['files_nested']:
+            with self.registry_lock:
+                entries = list(self.registry.items())
+            for key, entry in entries:
+                if (len(entry['files_nested'])):
+                    for each in entry['files_nested']:
                         temp.append(each['name'])
                 temp.append(key)
             self.wfile.write(json.dumps({'files': temp}, indent=4).encode('utf-8'))
         elif self.path.startswith('/get-peer'):
             query_components = parse_qs(urlparse(self.path).query)
-            piece_indices = query_components.get('piece_indices', [''])[0]
             filename = query_components.get('filename', [''])[0]
-            print('INDEX: ', piece_indices)
             print('NAME: ', filename)
-            try:
-                piece_indices = [int(index) for index in piece_indices.split(',')]
-            except ValueError:
-                self.send_error(400, "Invalid piece indices")
-                return
-            response_data = self.find_peers_by_piece_indices(filename, piece_indices)
+            if 'piece_ranges' in query_components:
+                print('RANGES: ', query_components['piece_ranges'][0])
+                try:
+                    ranges = parse_ranges(query_components['piece_ranges'][0])
+                except ValueError:
+                    self.send_error(400, "Invalid piece ranges")
+                    return
+                response_data = self.find_peers_by_ranges(filename, ranges)
+            else:
+                piece_indices = query_components.get('piece_indices', [''])[0]
+                print('INDEX: ', piece_indices)
+                try:
+                    piece_indices = [int(index) for index in piece_indices.split(',')]
+                except ValueError:
+                    self.send_error(400, "Invalid piece indices")
+                    return
+                response_data = self.find_peers_by_piece_indices(filename, piece_indices)
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
@@ -86,19 +430,41 @@ class TrackerHTTPServer(BaseHTTPRequestHandler):
             self.send_error(404, "File Not Found")
 
     def find_peers_by_piece_indices(self, filename, piece_indices):
-        file_data = self.registry.get(filename, {})
-        pieces_info = file_data.get('piece_indices', {})
-        result = {index: pieces_info.get(index, []) for index in piece_indices}
+        peers = self.live_peers(filename)
+        result = {index: [peer for peer, bitfield in peers if bitfield_has(bitfield, index)]
+                  for index in piece_indices}
         return result
 
+    def find_peers_by_ranges(self, filename, ranges):
+        peers = self.live_peers(filename)
+        limit = max((len(bitfield) * 8 for peer, bitfield in peers), default=0)
+        wanted = ranges_to_bitfield([(start, min(end, limit - 1)) for start, end in ranges if start < limit])
+        result = []
+        for (ip, port), bitfield in peers:
+            length = min(len(bitfield), len(wanted))
+            if int.from_bytes(bitfield[:length], 'big') & int.from_bytes(wanted[:length], 'big'):
+                result.append([ip, port, base64.b64encode(bytes(bitfield)).decode()])
+        return {'peers': result}
+
 
-def run(server_class=HTTPServer, handler_class=TrackerHTTPServer, port=8000):
+def run(server_class=ThreadingTrackerServer, handler_class=TrackerHTTPServer, port=8000, state_dir='tracker-state'):
+    journal = TrackerJournal(state_dir)
+    started = time.perf_counter()
+    replayed = journal.restore(handler_class.registry)
+    print(f"Restored {len(handler_class.registry)} files from {state_dir}, "
+          f"replayed {replayed} log records in {time.perf_counter() - started:.2f}s")
+    handler_class.journal = journal
+    journal.start(handler_class)
+    threading.Thread(target=handler_class.expire_loop, daemon=True).start()
     host_name = socket.gethostname()
     ip = socket.gethostbyname(host_name)
     server_address = (ip, port)
     httpd = server_class(server_address, handler_class)
     print(f"Starting httpd server on port {port}")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        journal.stop(handler_class)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Client1 import Peer
+
+
+def recv_exact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data.extend(chunk)
+    return data
+
+
+def client(peer, name, number_of_pieces, piece_size, duration, counts):
+    block_size = peer.handle_file.block_size
+    sock = socket.create_connection((peer.peer_ip, peer.port))
+    count = 0
+    deadline = time.perf_counter() + duration
+    with sock:
+        while time.perf_counter() < deadline:
+            index = count % number_of_pieces
+            offset = (count // number_of_pieces) % (piece_size // block_size) * block_size
+            sock.sendall(f"{index}-{offset} {name} block".encode())
+            recv_exact(sock, block_size)
+            count += 1
+    counts.append(count)
+
+
+def run(peer, name, number_of_pieces, clients, duration):
+    counts = []
+    threads = [threading.Thread(target=client, args=(peer, name, number_of_pieces,
+                                                      peer.handle_file.piece_size, duration, counts))
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback block serving throughput")
+    parser.add_argument('--size', type=int, default=64, help="payload size in MB")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        path = os.path.join(tmp, 'payload.bin')
+        with open(path, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+        peer = Peer(port=args.port)
+        piece_size = peer.handle_file.piece_size
+        total_size = args.size * 1024 * 1024
+        number_of_pieces = total_size // piece_size
+        peer.piece_store.add('payload.bin', piece_size, total_size, [(path, 0, total_size)])
+        peer.start()
+        time.sleep(0.2)
+        block_mb = peer.handle_file.block_size / (1024 * 1024)
+        for clients in args.clients:
+            results = {}
+            for mode in (False, True):
+                if mode and not hasattr(os, 'sendfile'):
+                    continue
+                peer.use_sendfile = mode
+                results[mode] = run(peer, 'payload.bin', number_of_pieces, clients, args.duration)
+            line = f"clients={clients:<3} copy {results[False]:9.0f} blocks/s ({results[False] * block_mb:7.1f} MB/s)"
+            if True in results:
+                line += (f"  sendfile {results[True]:9.0f} blocks/s ({results[True] * block_mb:7.1f} MB/s)"
+                         f"  x{results[True] / results[False]:.2f}")
+            print(line)
+        peer.stop()
+        peer.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import hashlib
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Client1 import Peer, CODECS, CODEC_ZLIB, CODEC_LZMA, CODEC_ZSTD
+
+CODEC_NAMES = {CODEC_ZLIB: 'zlib', CODEC_LZMA: 'lzma', CODEC_ZSTD: 'zstd'}
+
+
+class Link:
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.available = time.perf_counter()
+        self.transferred = 0
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.perf_counter()
+            self.available = max(self.available, now) + count / self.bandwidth
+            self.transferred += count
+            delay = self.available - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def pump(source, target, link=None):
+    try:
+        while True:
+            data = source.recv(16384)
+            if not data:
+                break
+            if link is not None:
+                link.consume(len(data))
+            target.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for sock in (source, target):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def proxy(listener, upstream, link):
+    while True:
+        try:
+            client, _ = listener.accept()
+        except OSError:
+            break
+        server = socket.create_connection(upstream)
+        for sock in (client, server):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=pump, args=(client, server), daemon=True).start()
+        threading.Thread(target=pump, args=(server, client, link), daemon=True).start()
+
+
+def log_lines(size):
+    rng = random.Random(0)
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARN', 'ERROR']
+    paths = ['/api/v1/items', '/api/v1/users', '/health', '/api/v1/orders', '/static/app.js']
+    lines = []
+    total = 0
+    second = 0
+    while total < size:
+        second += rng.randint(0, 2)
+        line = (f"2023-11-{1 + second // 86400:02d}T{second // 3600 % 24:02d}:{second // 60 % 60:02d}:"
+                f"{second % 60:02d} {rng.choice(levels)} worker-{rng.randint(1, 16)} "
+                f"id={rng.getrandbits(32):08x} path={rng.choice(paths)}/{rng.randint(1, 5000)} "
+                f"status={rng.choice([200, 200, 200, 304, 404, 500])} latency={rng.randint(1, 900)}ms\n")
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def fetch(client, addr, name, total_size, piece_size, block_size):
+    digest = hashlib.sha1()
+    for piece_index in range(-(-total_size // piece_size)):
+        length = min(piece_size, total_size - piece_index * piece_size)
+        wanted = [(piece_index, offset, min(block_size, length - offset)) for offset in range(0, length, block_size)]
+        blocks = client.request_blocks(addr, name, wanted)
+        for key in wanted:
+            digest.update(blocks[key[:2]])
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Block transfer over a bandwidth-limited loopback link, "
+                                                 "with and without compression")
+    parser.add_argument('--size', type=int, default=8, help="dataset size in MB")
+    parser.add_argument('--bandwidth', type=float, default=10.0, help="link bandwidth in MB/s")
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        total_size = args.size * 1024 * 1024
+        datasets = {'logs': log_lines(total_size), 'random': os.urandom(total_size)}
+        server = Peer(port=args.port)
+        for name, data in datasets.items():
+            path = os.path.join(tmp, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            server.piece_store.add(name, server.handle_file.piece_size, total_size, [(path, 0, total_size)])
+        server.start()
+
+        link = Link(args.bandwidth * 1024 * 1024)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((server.peer_ip, args.port + 1))
+        listener.listen()
+        threading.Thread(target=proxy, args=(listener, (server.peer_ip, args.port), link), daemon=True).start()
+        time.sleep(0.2)
+
+        codecs = [[]] + [[codec] for codec in (CODEC_ZLIB, CODEC_ZSTD, CODEC_LZMA) if codec in CODECS]
+        for name, data in datasets.items():
+            expected = hashlib.sha1(data).hexdigest()
+            for offset, codec in enumerate(codecs):
+                client = Peer(port=args.port + 2 + offset)
+                client.compression = codec
+                start_bytes = link.transferred
+                start = time.perf_counter()
+                digest = fetch(client, (server.peer_ip, args.port + 1), name, total_size,
+                               server.handle_file.piece_size, server.handle_file.block_size)
+                elapsed = time.perf_counter() - start
+                wire = link.transferred - start_bytes
+                client.connection_pool.close()
+                label = CODEC_NAMES[codec[0]] if codec else 'none'
+                print(f"{name:<7} {label:<5} {total_size / elapsed / 1024 / 1024:7.1f} MB/s  "
+                      f"wire {wire / 1024 / 1024:6.1f} MB ({wire / total_size:5.1%})  "
+                      f"{'ok' if digest == expected else 'HASH MISMATCH'}")
+        listener.close()
+        server.stop()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
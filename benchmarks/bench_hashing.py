@@ -0,0 +1,42 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Client1 import File
+
+
+def run(path, workers):
+    handle_file = File(path, '127.0.0.1')
+    handle_file.show_progress = lambda *args: None
+    handle_file.hash_workers = workers
+    start = time.perf_counter()
+    result = handle_file.divide_file_into_pieces(stream=True)
+    return time.perf_counter() - start, result['piece_hashes']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial vs parallel piece hashing")
+    parser.add_argument('--size', type=int, default=256, help="payload size in MB")
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payload.bin')
+        with open(path, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+        serial_time, serial_hashes = run(path, 1)
+        print(f"cpus={os.cpu_count()} size={args.size}MB pieces={len(serial_hashes)}")
+        print(f"serial      {serial_time:8.3f}s  {args.size / serial_time:8.1f} MB/s")
+        for workers in args.workers:
+            elapsed, hashes = run(path, workers)
+            assert hashes == serial_hashes
+            print(f"workers={workers:<3} {elapsed:8.3f}s  {args.size / elapsed:8.1f} MB/s  "
+                  f"speedup x{serial_time / elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
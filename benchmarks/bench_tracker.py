@@ -0,0 +1,113 @@
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Tracker import ThreadingTrackerServer, TrackerHTTPServer
+
+
+class QuietTracker(TrackerHTTPServer):
+    def log_message(self, format, *args):
+        pass
+
+
+def post(port, path, payload):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        conn.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+        conn.getresponse().read()
+    finally:
+        conn.close()
+
+
+def slow_post(port, path, payload, delay):
+    body = json.dumps(payload).encode()
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        conn.putrequest('POST', path)
+        conn.putheader('Content-Type', 'application/json')
+        conn.putheader('Content-Length', str(len(body)))
+        conn.endheaders()
+        time.sleep(delay)
+        conn.send(body)
+        conn.getresponse().read()
+    finally:
+        conn.close()
+
+
+def client(port, number, pieces, deadline, counts, errors):
+    count = 0
+    while time.perf_counter() < deadline:
+        payload = {
+            'peer_ip': '10.0.0.1',
+            'peer_port': 10000 + number,
+            'file_name': f"file-{count % 8}",
+            'pieces_indices': [count % pieces],
+        }
+        try:
+            post(port, '/peer-update-download', payload)
+        except OSError:
+            errors.append(number)
+            continue
+        count += 1
+    counts.append(count)
+
+
+def run(server_class, port, clients, pieces, duration, slow):
+    TrackerHTTPServer.registry.clear()
+    TrackerHTTPServer.file_locks.clear()
+    httpd = server_class(('127.0.0.1', port), QuietTracker)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    for number in range(8):
+        post(port, '/peer-update', {'peer_ip': '10.0.0.0', 'peer_port': 9999, 'file_name': f"file-{number}",
+                                    'pieces_indices': list(range(pieces)), 'file_details': None})
+    if slow:
+        threading.Thread(target=slow_post, daemon=True, args=(
+            port, '/peer-update', {'peer_ip': '10.0.0.2', 'peer_port': 9998, 'file_name': 'file-0',
+                                   'pieces_indices': [0], 'file_details': None}, duration + 0.5)).start()
+        time.sleep(0.2)
+    deadline = time.perf_counter() + duration
+    counts = []
+    errors = []
+    threads = [threading.Thread(target=client, args=(port, number, pieces, deadline, counts, errors))
+               for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    httpd.shutdown()
+    httpd.server_close()
+    return sum(counts) / duration, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracker announces per second against client concurrency")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--pieces', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--slow', action='store_true', help="keep one client stalled mid-upload for the whole run")
+    args = parser.parse_args()
+
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for clients in args.clients:
+            row = [clients]
+            for server_class in (HTTPServer, ThreadingTrackerServer):
+                row.append(run(server_class, args.port, clients, args.pieces, args.duration, args.slow))
+            results.append(row)
+    for clients, (single, single_errors), (threaded, threaded_errors) in results:
+        print(f"clients={clients:<3} HTTPServer {single:8.0f} announces/s ({single_errors} errors)  "
+              f"ThreadingTrackerServer {threaded:8.0f} announces/s ({threaded_errors} errors)")
+
+
+if __name__ == "__main__":
+    main()
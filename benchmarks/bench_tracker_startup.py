@@ -0,0 +1,79 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Tracker import TrackerHTTPServer, TrackerJournal, merge_announce, ranges_to_bitfield
+
+
+class BenchTracker(TrackerHTTPServer):
+    registry = {}
+    file_locks = {}
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def restore(directory):
+    registry = {}
+    journal = TrackerJournal(directory)
+    start = time.perf_counter()
+    replayed = journal.restore(registry)
+    elapsed = time.perf_counter() - start
+    journal.log.close()
+    return registry, replayed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracker restart time from snapshot and append-only log")
+    parser.add_argument('--pieces', type=int, default=100000)
+    parser.add_argument('--peers', type=int, default=1000)
+    parser.add_argument('--tail', type=int, default=10000, help="delta announces logged after the snapshot")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = TrackerJournal(tmp, snapshot_records=float('inf'))
+        journal.restore(BenchTracker.registry)
+        start = time.perf_counter()
+        for number in range(args.peers):
+            peer = ('10.0.%d.%d' % (number // 256, number % 256), 6881)
+            first = rng.randrange(args.pieces)
+            ranges = [(first, min(args.pieces - 1, first + rng.randrange(args.pieces // 2)))]
+            bitfield = ranges_to_bitfield(ranges)
+            merge_announce(BenchTracker.registry, 'bench', peer, bitfield)
+            journal.append('bench', peer, bitfield)
+        print(f"logged {args.peers} full announces in {time.perf_counter() - start:.2f}s, "
+              f"{directory_size(tmp) / 1024 / 1024:.1f} MB on disk")
+        _, replayed, elapsed = restore(tmp)
+        print(f"log only:          replayed {replayed:6d} records in {elapsed:6.2f}s")
+
+        start = time.perf_counter()
+        journal.snapshot(BenchTracker)
+        print(f"snapshot written in {time.perf_counter() - start:.2f}s, "
+              f"{os.path.getsize(journal.snapshot_path) / 1024 / 1024:.1f} MB")
+        _, replayed, elapsed = restore(tmp)
+        print(f"snapshot:          replayed {replayed:6d} records in {elapsed:6.2f}s")
+
+        for _ in range(args.tail):
+            number = rng.randrange(args.peers)
+            peer = ('10.0.%d.%d' % (number // 256, number % 256), 6881)
+            first = rng.randrange(args.pieces)
+            bitfield = ranges_to_bitfield([(first, min(args.pieces - 1, first + 7))])
+            merge_announce(BenchTracker.registry, 'bench', peer, bitfield)
+            journal.append('bench', peer, bitfield)
+        registry, replayed, elapsed = restore(tmp)
+        print(f"snapshot + tail:   replayed {replayed:6d} records in {elapsed:6.2f}s")
+        journal.stop(BenchTracker)
+
+        expected = {peer: bytes(bitfield) for peer, bitfield in BenchTracker.registry['bench']['peers'].items()}
+        restored = {peer: bytes(bitfield) for peer, bitfield in registry['bench']['peers'].items()}
+        print('registry restored intact' if expected == restored else 'REGISTRY MISMATCH')
+
+
+if __name__ == "__main__":
+    main()